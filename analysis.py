@@ -0,0 +1,180 @@
+"""
+WordGuess Word List Analysis
+Author: Brandon Rozek
+
+Offline tool for judging how hard a word list
+is. It computes the hint for every guess/answer
+pair of words with the same length, using the
+same rules as WordGuessServer.compare, and plays
+every word as the answer with a greedy solver.
+
+Requires numpy. The hint matrix is cached under
+cache/ as a .npy file and memory-mapped on
+later runs.
+
+Usage
+=====
+python analysis.py --length 5 --guesses 6
+"""
+from pathlib import Path
+import argparse
+import hashlib
+import os
+
+import numpy as np
+
+from analytics import CORRECT, MISS, PRESENT
+from dictionary import WORDS_LOCATION
+
+SERVER_FOLDER = Path(__file__).parent.absolute()
+CACHE_FOLDER = f"{SERVER_FOLDER}/cache"
+BLOCK_SIZE = 256
+
+def load_words(location, length):
+    with open(location, "r") as file:
+        return [l for l in file.read().splitlines() if len(l) == length]
+
+def hint_dtype(length):
+    if 3 ** length <= 2 ** 8:
+        return np.uint8
+    if 3 ** length <= 2 ** 16:
+        return np.uint16
+    return np.uint32
+
+def encode_words(words):
+    """
+    Words as a (number of words, length)
+    array of character codes.
+    """
+    length = len(words[0])
+    return np.frombuffer("".join(words).encode("utf-32-le"), dtype=np.uint32).reshape(-1, length)
+
+def hint_block(guesses, answers):
+    """
+    Hint codes for every guess in a block
+    against every answer.
+    """
+    length = guesses.shape[1]
+    exact = guesses[:, None, :] == answers[None, :, :]
+    codes = np.zeros((guesses.shape[0], answers.shape[0]), dtype=np.uint32)
+    present = []
+    for i in range(length):
+        letter = guesses[:, i][:, None, None]
+        in_answer = (answers[None, :, :] == letter).sum(axis=2)
+
+        # A * for this letter is only given while the
+        # answer has more of it than the *s to its left
+        given = np.zeros_like(in_answer)
+        for j in range(i):
+            same = (guesses[:, j] == guesses[:, i])[:, None]
+            given += same & present[j]
+        present.append(~exact[:, :, i] & (given < in_answer))
+
+        value = np.where(exact[:, :, i], CORRECT, np.where(present[i], PRESENT, MISS))
+        codes += value.astype(np.uint32) * 3 ** i
+    return codes
+
+def cache_location(words):
+    digest = hashlib.sha1("\n".join(words).encode()).hexdigest()[:12]
+    return f"{CACHE_FOLDER}/hints-{len(words[0])}-{digest}.npy"
+
+def hint_matrix(words):
+    """
+    Return the (guess, answer) matrix of hint codes,
+    computing it only if it isn't cached for this
+    exact list of words.
+    """
+    location = cache_location(words)
+    if os.path.exists(location):
+        return np.load(location, mmap_mode="r")
+
+    Path(CACHE_FOLDER).mkdir(exist_ok=True)
+    chars = encode_words(words)
+    partial = f"{location}.partial"
+    matrix = np.lib.format.open_memmap(
+        partial, mode="w+", dtype=hint_dtype(chars.shape[1]), shape=(len(words), len(words))
+    )
+    for start in range(0, len(words), BLOCK_SIZE):
+        block = chars[start:start + BLOCK_SIZE]
+        matrix[start:start + len(block)] = hint_block(block, chars)
+    matrix.flush()
+    del matrix
+    os.replace(partial, location)
+    return np.load(location, mmap_mode="r")
+
+class GreedySolver:
+    """
+    Picks the guess that splits the remaining
+    candidates into the most distinct hints.
+    Decisions only depend on the hints seen so
+    far, so they're shared between answers.
+    """
+    def __init__(self, matrix):
+        self.matrix = matrix
+        self.decisions = dict()
+
+    def next_guess(self, history, candidates):
+        guess = self.decisions.get(history)
+        if guess is not None:
+            return guess
+
+        if len(candidates) <= 2:
+            guess = int(candidates[0])
+        else:
+            best = None
+            for start in range(0, self.matrix.shape[0], BLOCK_SIZE):
+                hints = np.sort(self.matrix[start:start + BLOCK_SIZE][:, candidates], axis=1)
+                splits = (np.diff(hints, axis=1) != 0).sum(axis=1) + 1
+                # Prefer guesses that could be the answer
+                splits = splits * 2 + np.isin(np.arange(start, start + len(splits)), candidates)
+                i = int(np.argmax(splits))
+                if best is None or splits[i] > best[0]:
+                    best = (splits[i], start + i)
+            guess = best[1]
+
+        self.decisions[history] = guess
+        return guess
+
+    def play(self, answer, guesses_allowed):
+        """
+        Number of guesses needed to find answer,
+        or None if it wasn't found in time.
+        """
+        candidates = np.arange(self.matrix.shape[0])
+        history = ()
+        for attempt in range(1, guesses_allowed + 1):
+            guess = self.next_guess(history, candidates)
+            if guess == answer:
+                return attempt
+            hint = self.matrix[guess, answer]
+            candidates = candidates[self.matrix[guess, candidates] == hint]
+            history += ((guess, int(hint)),)
+        return None
+
+def difficulty(words, guesses_allowed):
+    matrix = hint_matrix(words)
+    solver = GreedySolver(matrix)
+    return [solver.play(answer, guesses_allowed) for answer in range(len(words))]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Difficulty analysis of a WordGuess word list")
+    parser.add_argument("--words", type=str, default=WORDS_LOCATION, help="Word list to analyze.")
+    parser.add_argument("--length", type=int, default=5, help="Length of the words of the day.")
+    parser.add_argument("--guesses", type=int, default=6, help="Guesses allowed per day.")
+    parser.add_argument("--hardest", type=int, default=10, help="Number of hardest words to list.")
+    args = parser.parse_args()
+
+    words = load_words(args.words, args.length)
+    results = difficulty(words, args.guesses)
+
+    solved = [r for r in results if r is not None]
+    print(f"Words of length {args.length}: {len(words)}")
+    print(f"Solved within {args.guesses} guesses: {len(solved)} ({100 * len(solved) / len(words):.1f}%)")
+    if solved:
+        print(f"Average guesses when solved: {sum(solved) / len(solved):.2f}")
+    for attempts in range(1, args.guesses + 1):
+        print(f"  {attempts}: {results.count(attempts)}")
+    print(f"  failed: {results.count(None)}")
+
+    hardest = sorted(range(len(words)), key=lambda i: (results[i] is not None, -(results[i] or 0)))
+    print("Hardest words:", " ".join(words[i] for i in hardest[:args.hardest]))
@@ -0,0 +1,437 @@
+"""
+WordGuess Game Analytics
+Author: Brandon Rozek
+
+Records every finished game, lost or won, along
+with each of its guesses, their hints and when
+they were made. Records go to their own database
+(analytics.db) on a background thread, so they
+never touch the results that leaderboard.py reads.
+
+Once a day can't be played anymore, its games
+are moved out of the database into one compact
+file per game and day under archive/. Each column
+is compressed on its own and guesses are dictionary
+encoded, so queries only read and decode the
+columns they need. Queries only look at the archive.
+
+Usage
+=====
+python analytics.py solve-rate --top 20
+python analytics.py distribution --since 2024-01-01
+python analytics.py user brozek
+python analytics.py archive
+"""
+from array import array
+from collections import Counter, defaultdict
+from datetime import date, datetime, timedelta
+import argparse
+import json
+import os
+import sqlite3
+import struct
+import sys
+import time
+import zlib
+
+from results import BatchWriter
+from state import make_private
+from wordguess import WordGuess
+
+SERVER_FOLDER = os.path.dirname(os.path.abspath(__file__))
+ANALYTICS_LOCATION = f"{SERVER_FOLDER}/analytics.db"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS guesses(
+    date TEXT NOT NULL,
+    variant TEXT NOT NULL,
+    user TEXT NOT NULL,
+    number INT NOT NULL,
+    word TEXT NOT NULL,
+    hint INT NOT NULL,
+    at REAL NOT NULL,
+    PRIMARY KEY (date, variant, user, number)
+);
+CREATE TABLE IF NOT EXISTS games(
+    date TEXT NOT NULL,
+    variant TEXT NOT NULL,
+    user TEXT NOT NULL,
+    word TEXT NOT NULL,
+    won INT NOT NULL,
+    guesses INT NOT NULL,
+    PRIMARY KEY (date, variant, user)
+);
+"""
+
+# Per position values of a hint, combined into
+# one number as digits in base 3. Shared with
+# analysis.py, which can't be imported without numpy.
+MISS, PRESENT, CORRECT = 0, 1, 2
+
+MAGIC = b"WGA1"
+U32 = struct.Struct("<I")
+COMPRESSION = 6
+
+def encode_hint(hint) -> int:
+    code = 0
+    for i, c in enumerate(hint):
+        value = MISS if c == "_" else PRESENT if c == "*" else CORRECT
+        code += value * 3 ** i
+    return code
+
+def decode_hint(code: int, word: str):
+    hint = []
+    for c in word:
+        code, value = divmod(code, 3)
+        hint.append("_" if value == MISS else "*" if value == PRESENT else c)
+    return hint
+
+def archive_folder(location) -> str:
+    """
+    Closed days are archived next
+    to the analytics database.
+    """
+    return os.path.join(os.path.dirname(os.path.abspath(location)), "archive")
+
+class AnalyticsWriter(BatchWriter):
+    """
+    Same as results.ResultsWriter, except for
+    guesses and games. It also archives each day
+    once it's closed.
+    """
+    name = "analytics-writer"
+
+    def __init__(self, location: str = ANALYTICS_LOCATION, **kwargs):
+        # Every player's guesses stay private
+        make_private(location)
+        self.archive = archive_folder(location)
+        self.archived_on = None
+        super().__init__(location, **kwargs)
+
+    def guess(self, date, variant: str, user: str, number: int, word: str, hint):
+        """
+        Queue a valid guess, the first of a game
+        being number 0. Returns right away.
+        """
+        self.queue.put(("guesses", (str(date), variant, user, number, word, encode_hint(hint), time.time())))
+
+    def game(self, date, variant: str, user: str, word: str, won: bool, guesses: int):
+        """
+        Queue a game that ran to the end.
+        """
+        self.queue.put(("games", (str(date), variant, user, word, won, guesses)))
+
+    def run(self):
+        con = sqlite3.connect(self.location)
+        con.execute("PRAGMA journal_mode=WAL")
+        con.execute("PRAGMA synchronous=NORMAL")
+        con.executescript(SCHEMA)
+        try:
+            self.archive_closed_days(con)
+            for batch in self.batches():
+                self.write(con, batch)
+                self.archive_closed_days(con)
+        finally:
+            con.close()
+
+    @staticmethod
+    def write(con, batch):
+        with con:
+            for table, row in batch:
+                con.execute(
+                    f"INSERT OR REPLACE INTO {table} VALUES ({', '.join('?' * len(row))})", row
+                )
+
+    def archive_closed_days(self, con):
+        """
+        Archive once a day, after the
+        first record of the day.
+        """
+        today = date.today()
+        if self.archived_on == today:
+            return
+        self.archived_on = today
+        archive_closed_days(con, self.archive, today)
+
+##
+# Archive
+##
+
+def archive_closed_days(con, folder, today):
+    """
+    Move the games of every day before yesterday into
+    the archive. Yesterday's games can still finish
+    past midnight. Guesses of games that were never
+    finished are dropped.
+    """
+    cutoff = str(today - timedelta(days=1))
+    days = con.execute(
+        "SELECT date, variant FROM games WHERE date < ? "
+        "UNION SELECT date, variant FROM guesses WHERE date < ?",
+        (cutoff, cutoff)
+    ).fetchall()
+    for day, variant in sorted(days):
+        archive_day(con, folder, day, variant)
+        with con:
+            con.execute("DELETE FROM games WHERE date = ? AND variant = ?", (day, variant))
+            con.execute("DELETE FROM guesses WHERE date = ? AND variant = ?", (day, variant))
+
+def archive_day(con, folder, day, variant):
+    games = con.execute(
+        "SELECT user, word, won, guesses FROM games WHERE date = ? AND variant = ? ORDER BY user",
+        (day, variant)
+    ).fetchall()
+    if not games:
+        return
+
+    history = defaultdict(list)
+    rows = con.execute(
+        "SELECT user, word, hint, at FROM guesses WHERE date = ? AND variant = ? ORDER BY user, number",
+        (day, variant)
+    )
+    for user, word, hint, at in rows:
+        history[user].append((word, hint, at))
+
+    users = []
+    won = array("B")
+    guesses = array("B")
+    started = array("I")
+    guess_words = []
+    # Hints of words past 10 letters don't fit in 16 bits
+    hints = array("H" if 3 ** len(games[0][1]) <= 0x10000 else "I")
+    times = array("I")
+    midnight = datetime.fromisoformat(day).timestamp()
+    for user, _, is_winner, count in games:
+        # Guesses that weren't saved, say after a crash,
+        # leave a game shorter than its count
+        made = history.get(user, [])[:count]
+        users.append(user)
+        won.append(bool(is_winner))
+        guesses.append(len(made))
+        first = made[0][2] if made else midnight
+        started.append(max(0, int(first - midnight)))
+        for word, hint, at in made:
+            guess_words.append(word)
+            hints.append(hint)
+            times.append(max(0, int(1000 * (at - first))))
+
+    words = sorted(set(guess_words))
+    index = {w: i for i, w in enumerate(words)}
+    guess = array("H" if len(words) <= 0xFFFF else "I", (index[w] for w in guess_words))
+
+    write_archive(
+        archive_location(folder, variant, day),
+        dict(date=day, variant=variant, word=games[0][1], games=len(games), wins=sum(won)),
+        dict(
+            user=users, won=won, guesses=guesses, started=started,
+            words=words, guess=guess, hint=hints, time=times
+        )
+    )
+
+def archive_location(folder, variant, day) -> str:
+    """
+    A new file for the day, next to any
+    written before for the same day.
+    """
+    location = f"{folder}/{variant}/{day}.wga"
+    extra = 1
+    while os.path.exists(location):
+        location = f"{folder}/{variant}/{day}.{extra}.wga"
+        extra += 1
+    return location
+
+def write_archive(location, header, columns):
+    """
+    File layout: MAGIC, length of the header, the
+    header as JSON, then each column compressed.
+    The header says where each column is and how
+    to decode it. Arrays are little-endian, lists
+    of strings are joined by newlines.
+    """
+    blobs = []
+    header["columns"] = dict()
+    offset = 0
+    for name, values in columns.items():
+        if isinstance(values, array):
+            kind = values.typecode
+            if sys.byteorder == "big":
+                values = array(kind, values)
+                values.byteswap()
+            data = values.tobytes()
+        else:
+            kind = "str"
+            data = "\n".join(values).encode()
+        blob = zlib.compress(data, COMPRESSION)
+        header["columns"][name] = [kind, offset, len(blob)]
+        blobs.append(blob)
+        offset += len(blob)
+
+    head = json.dumps(header).encode()
+    # Like the database, the archive stays private
+    folder = os.path.dirname(location)
+    os.makedirs(os.path.dirname(folder), mode=0o700, exist_ok=True)
+    os.makedirs(folder, mode=0o700, exist_ok=True)
+    # Readers never see a half written file
+    partial = f"{location}.partial"
+    with open(os.open(partial, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "wb") as file:
+        file.write(MAGIC + U32.pack(len(head)) + head)
+        for blob in blobs:
+            file.write(blob)
+    os.replace(partial, location)
+
+class ArchiveFile:
+    """
+    One game and day of the archive. Only the header
+    is read up front, columns are read on demand.
+    """
+    def __init__(self, location):
+        self.location = location
+        with open(location, "rb") as file:
+            if file.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f"{location} is not an archive file")
+            (length,) = U32.unpack(file.read(U32.size))
+            self.header = json.loads(file.read(length))
+        self.data_start = len(MAGIC) + U32.size + length
+        self.date = date.fromisoformat(self.header["date"])
+
+    def __getattr__(self, name):
+        try:
+            return self.header[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def column(self, name):
+        kind, offset, size = self.header["columns"][name]
+        with open(self.location, "rb") as file:
+            file.seek(self.data_start + offset)
+            data = zlib.decompress(file.read(size))
+        if kind == "str":
+            return data.decode().split("\n") if data else []
+        values = array(kind)
+        values.frombytes(data)
+        if sys.byteorder == "big":
+            values.byteswap()
+        return values
+
+def archive_files(folder, variant, since=None, until=None):
+    """
+    Archive files of a game in date order,
+    between since and until if given.
+    """
+    location = f"{folder}/{variant}"
+    if not os.path.isdir(location):
+        return []
+    files = []
+    for name in sorted(os.listdir(location)):
+        if not name.endswith(".wga"):
+            continue
+        day = date.fromisoformat(name[:10])
+        if (since is None or day >= since) and (until is None or day <= until):
+            files.append(ArchiveFile(f"{location}/{name}"))
+    return files
+
+##
+# Queries
+##
+
+def solve_rates(files):
+    """
+    word -> [games, wins, guesses taken by the wins]
+    """
+    rates = defaultdict(lambda: [0, 0, 0])
+    for f in files:
+        r = rates[f.word]
+        r[0] += f.games
+        r[1] += f.wins
+        if f.wins:
+            # Only what a won game took, which
+            # is a sum over the two columns
+            r[2] += sum(g for g, w in zip(f.column("guesses"), f.column("won")) if w)
+    return rates
+
+def guess_distribution(files) -> Counter:
+    """
+    Number of guesses a game took to win -> games.
+    Lost games are counted under 0.
+    """
+    distribution = Counter()
+    for f in files:
+        distribution.update(map(int.__mul__, f.column("guesses"), f.column("won")))
+    return distribution
+
+def user_trend(files, user):
+    """
+    (date, won, guesses, seconds from first to last
+    guess) of every game the user finished.
+    """
+    trend = []
+    for f in files:
+        users = f.column("user")
+        try:
+            i = users.index(user)
+        except ValueError:
+            continue
+        guesses = f.column("guesses")
+        count = guesses[i]
+        duration = 0
+        if count:
+            # Guesses of every game are stored
+            # one after the other
+            times = f.column("time")
+            duration = times[sum(guesses[:i]) + count - 1] / 1000
+        trend.append((f.date, bool(f.column("won")[i]), count, duration))
+    return trend
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Analytics of every finished WordGuess game")
+    parser.add_argument("--database", type=str, default=ANALYTICS_LOCATION, help="Location of analytics.db.")
+    parser.add_argument(
+        "--variant", type=str, default=WordGuess.DEFAULT_VARIANT, choices=WordGuess.VARIANTS,
+        help="Game to look at."
+    )
+    parser.add_argument("--since", type=date.fromisoformat, help="First day to look at, as YYYY-MM-DD.")
+    parser.add_argument("--until", type=date.fromisoformat, help="Last day to look at, as YYYY-MM-DD.")
+    subparsers = parser.add_subparsers(dest="query", required=True)
+    rates = subparsers.add_parser("solve-rate", help="How often each word of the day was solved, hardest first.")
+    rates.add_argument("--top", type=int, help="Only show the first N words.")
+    subparsers.add_parser("distribution", help="How many guesses games took.")
+    user = subparsers.add_parser("user", help="How a player did month by month.")
+    user.add_argument("name", type=str)
+    subparsers.add_parser("archive", help="Archive closed days now instead of waiting for the server.")
+    args = parser.parse_args()
+
+    folder = archive_folder(args.database)
+    if args.query == "archive":
+        con = sqlite3.connect(args.database)
+        con.executescript(SCHEMA)
+        archive_closed_days(con, folder, date.today())
+        con.close()
+        sys.exit(0)
+
+    start = time.perf_counter()
+    files = archive_files(folder, args.variant, args.since, args.until)
+    games = sum(f.games for f in files)
+
+    if args.query == "solve-rate":
+        print("Word, games, solved, average guesses when solved")
+        rates = sorted(solve_rates(files).items(), key=lambda r: r[1][1] / r[1][0])
+        for word, (played, wins, taken) in rates[:args.top]:
+            print(f"{word} {played} {100 * wins / played:.1f}% {taken / wins if wins else 0:.2f}")
+    elif args.query == "distribution":
+        distribution = guess_distribution(files)
+        print("Guesses, games")
+        for guesses in sorted(distribution):
+            count = distribution[guesses]
+            print(f"{guesses or 'lost'} {count} ({100 * count / max(games, 1):.1f}%)")
+    else:
+        print(f"Month, games, won, average guesses, average seconds for '{args.name}'")
+        months = defaultdict(list)
+        for day, won, guesses, duration in user_trend(files, args.name):
+            months[day.strftime("%Y-%m")].append((won, guesses, duration))
+        for month, played in sorted(months.items()):
+            n = len(played)
+            print(
+                f"{month} {n} {100 * sum(p[0] for p in played) / n:.1f}% "
+                f"{sum(p[1] for p in played) / n:.2f} {sum(p[2] for p in played) / n:.1f}"
+            )
+    print(f"Scanned {games} games in {len(files)} days in {time.perf_counter() - start:.2f} s", file=sys.stderr)
@@ -0,0 +1,261 @@
+"""
+WordGuess Microbenchmarks
+Author: Brandon Rozek
+
+Times hot paths of the server against
+the way they used to be implemented.
+
+Usage
+=====
+python benchmark.py words
+python benchmark.py hints
+python benchmark.py login
+python benchmark.py codec
+python benchmark.py startup
+"""
+from datetime import date
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from threading import Thread
+from timeit import Timer
+import argparse
+import os
+import random
+import shutil
+import subprocess
+import sys
+import time
+
+from dictionary import WORDS_LOCATION, PackedIndex, WordIndex, write_packed
+
+SERVER_FOLDER = Path(__file__).parent.absolute()
+
+def report(name, fn, number):
+    """
+    Print the best per-call time of fn
+    over a few repeats.
+    """
+    best = min(Timer(fn).repeat(repeat=5, number=number)) / number
+    print(f"{name:<30} {best * 1e9:>12.1f} ns/call")
+
+def bench_words(args):
+    with open(WORDS_LOCATION, "r") as file:
+        lines = file.read().splitlines()
+    word_list = [l for l in lines if len(l) == args.length]
+    index = WordIndex(lines)
+    bucket = index.words_of_length(args.length)
+
+    # Half of the probes are real words, the
+    # other half are shuffled letters which
+    # are most likely not.
+    rng = random.Random(0)
+    probes = rng.sample(word_list, 50)
+    probes += ["".join(rng.sample(w, len(w))) for w in probes]
+    assert all((p in word_list) == (p in index) == (p in bucket) for p in probes)
+
+    number = args.number
+    report("list scan", lambda: [p in word_list for p in probes], number)
+    report("frozenset", lambda: [p in index for p in probes], number)
+    report("sorted array bisection", lambda: [p in bucket for p in probes], number)
+    report("load words.txt", lambda: WordIndex.from_file(), 1)
+
+    # The packed dictionary, built fresh
+    # so that it matches words.txt
+    with TemporaryDirectory() as folder:
+        location = f"{folder}/words.dict"
+        write_packed(lines, location)
+        packed = PackedIndex(location)
+        assert all((p in packed) == (p in index) for p in probes)
+        assert list(packed.words_of_length(args.length)) == list(bucket)
+        report("packed blocks", lambda: [p in packed for p in probes], number)
+        report("load words.dict", lambda: PackedIndex(location), 1)
+
+def bench_hints(args):
+    from server import HintEngine, WordGuessServer
+
+    with open(WORDS_LOCATION, "r") as file:
+        words = [l for l in file.read().splitlines() if len(l) == args.length]
+    rng = random.Random(0)
+
+    # The engine has to agree with compare on every
+    # guess in the dictionary, and on random strings
+    # drawn from a few letters so that repeats are common.
+    answers = rng.sample(words, args.answers)
+    for answer in answers:
+        engine = HintEngine(answer)
+        for guess in words:
+            assert engine.hint(guess) == WordGuessServer.compare(answer, guess), (answer, guess)
+    for _ in range(100000):
+        answer = "".join(rng.choices("abcde", k=args.length))
+        guess = "".join(rng.choices("abcde", k=args.length))
+        assert HintEngine(answer).hint(guess) == WordGuessServer.compare(answer, guess), (answer, guess)
+    print(f"HintEngine matches compare on {len(answers) * len(words)} dictionary pairs")
+
+    answer = answers[0]
+    engine = HintEngine(answer)
+    number = max(1, args.number // 100)
+    report("compare (whole dictionary)", lambda: [WordGuessServer.compare(answer, g) for g in words], number)
+    report("HintEngine (whole dictionary)", lambda: [engine.hint(g) for g in words], number)
+
+def bench_login(args):
+    from loadtest import wait_until_listening
+    from pubnix import login, run_simple_server, start_client
+
+    with TemporaryDirectory() as folder:
+        address = f"{folder}/bench.sock"
+        server = Thread(
+            target=run_simple_server,
+            args=[address, lambda connection, user: None],
+            daemon=True
+        )
+        server.start()
+        wait_until_listening(None, address, interval=0.01)
+
+        for mode, peercred in (("challenge", False), ("peercred", True)):
+            def one_login():
+                with start_client(address) as client:
+                    _, success = login(client, peercred=peercred)
+                    assert success
+            report(f"login ({mode})", one_login, args.number)
+
+def bench_codec(args):
+    from dataclasses import asdict
+    import json
+    from pubnix import PROTOCOL_VERSION, decode_message, encode_message
+    from wordguess import WordGuess
+
+    message = WordGuess.GuessResponseMessage(
+        4, True, False, ["_", "*", "l", "*", "_"], ["e", "h", "l", "o", "r", "s", "t"]
+    )
+    cls = WordGuess.GuessResponseMessage
+
+    # How messages were sent before codecs
+    def legacy():
+        payload = json.dumps(asdict(message)).encode()
+        return cls(**json.loads(payload))
+
+    def roundtrip(codec):
+        # Strip the length prefix
+        payload = encode_message(message, PROTOCOL_VERSION, codec)[4:]
+        return decode_message(payload, cls)
+
+    assert legacy() == roundtrip("json") == roundtrip("binary") == message
+    for codec in ("json", "binary"):
+        size = len(encode_message(message, PROTOCOL_VERSION, codec)) - 4
+        print(f"{codec} message size: {size} bytes")
+    number = args.number * 100
+    report("asdict + json (before)", legacy, number)
+    report("json codec", lambda: roundtrip("json"), number)
+    report("binary codec", lambda: roundtrip("binary"), number)
+
+def wall_time(command, **kwargs):
+    start = time.perf_counter()
+    subprocess.run(command, cwd=SERVER_FOLDER, check=True, **kwargs)
+    return time.perf_counter() - start
+
+def first_guess(server, address):
+    """
+    Seconds until the server at address answers
+    a login and a guess, retrying until it listens.
+    """
+    from loadtest import wait_until_listening
+    from pubnix import PROTOCOL_VERSION, StartMessage, login, receive_message, send_message, start_client
+    from wordguess import WordGuess
+
+    start = time.perf_counter()
+    wait_until_listening(server, address, interval=0.001)
+    listening = time.perf_counter() - start
+    with start_client(address) as client:
+        login(client)
+        send_message(client, StartMessage(version=PROTOCOL_VERSION))
+        receive_message(client, WordGuess.GameStartMessage)
+        send_message(client, WordGuess.GuessMessage("hello"))
+        receive_message(client, WordGuess.GuessResponseMessage)
+    return listening, time.perf_counter() - start
+
+def bench_startup(args):
+    from state import StateStore
+    from wordguess import WordGuess
+
+    # Interpreter startup on its own, to
+    # subtract from the import times
+    python = min(wall_time([sys.executable, "-c", "pass"]) for _ in range(args.repeat))
+    for module in ("client", "server"):
+        best = min(wall_time([sys.executable, "-c", f"import {module}"]) for _ in range(args.repeat))
+        print(f"import {module:<24} {(best - python) * 1000:>10.1f} ms")
+
+    with TemporaryDirectory() as folder:
+        state = f"{folder}/state.db"
+        # A busy day's worth of players for
+        # the server to load when it starts
+        store = StateStore(state)
+        store.set_setting("seed", 12345)
+        today = str(date.today())
+        store.save_players(
+            (today, WordGuess.DEFAULT_VARIANT, f"player{i}", 3, False, "aehlorst", "hello")
+            for i in range(args.players)
+        )
+        store.close()
+
+        results = []
+        for _ in range(args.repeat):
+            address = f"{folder}/game.sock"
+            # Our own guesses would use up the game after a few runs
+            run_state = f"{folder}/run.db"
+            shutil.copy(state, run_state)
+            server = subprocess.Popen(
+                [
+                    sys.executable, "server.py", "--address", address,
+                    "--state", run_state, "--results", f"{folder}/results.db",
+                    "--analytics", f"{folder}/analytics.db"
+                ],
+                cwd=SERVER_FOLDER,
+                stdout=subprocess.DEVNULL
+            )
+            try:
+                listening, guess = first_guess(server, address)
+                # A player running the client for
+                # the first time against this server
+                client = wall_time(
+                    [sys.executable, "client.py", "--address", address],
+                    input=b"hello\n", stdout=subprocess.DEVNULL, env=dict(os.environ, HOME=folder)
+                )
+                results.append((listening, guess, client))
+            finally:
+                server.terminate()
+                server.wait()
+                if os.path.exists(address):
+                    os.unlink(address)
+
+    listening, guess, client = (min(r) for r in zip(*results))
+    print(f"server listening{'':<17} {listening * 1000:>10.1f} ms ({args.players} players today)")
+    print(f"server first guess{'':<15} {guess * 1000:>10.1f} ms")
+    print(f"client first guess{'':<15} {client * 1000:>10.1f} ms")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Microbenchmarks for WordGuess")
+    parser.add_argument("--number", type=int, default=100, help="Calls per repeat.")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    words = subparsers.add_parser("words", help="Guess validation against the dictionary.")
+    words.add_argument("--length", type=int, default=5)
+    words.set_defaults(fn=bench_words)
+
+    hints = subparsers.add_parser("hints", help="Hints for a guess against the word of the day.")
+    hints.add_argument("--length", type=int, default=5)
+    hints.add_argument("--answers", type=int, default=50, help="Answers to check against every guess.")
+    hints.set_defaults(fn=bench_hints)
+
+    login = subparsers.add_parser("login", help="Connecting and authenticating to a server.")
+    login.set_defaults(fn=bench_login)
+
+    codec = subparsers.add_parser("codec", help="Encoding and decoding a guess response.")
+    codec.set_defaults(fn=bench_codec)
+
+    startup = subparsers.add_parser("startup", help="Import times and time to the first guess.")
+    startup.add_argument("--repeat", type=int, default=5, help="Runs to take the best of.")
+    startup.add_argument("--players", type=int, default=100000, help="Players in the state the server loads.")
+    startup.set_defaults(fn=bench_startup)
+
+    args = parser.parse_args()
+    args.fn(args)
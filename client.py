@@ -3,6 +3,8 @@ Author: Brandon Rozek
 Client for the WordGuess pubnix game.
 """
 from datetime import datetime
+import os
+import sys
 from pubnix import (
     run_simple_client,
     send_message,
@@ -10,6 +12,10 @@ from pubnix import (
 )
 from wordguess import WordGuess
 
+# Lets players reconnect without
+# redoing the login challenge
+SESSION_LOCATION = os.path.expanduser("~/.wordguess_session")
+
 ## Messages
 
 STARTUP_MESSAGE = lambda nc, td: f"""
@@ -31,6 +37,11 @@ Come back tomorrow! Your score: {score}
 
 GUESSES_REMAINING = lambda gr: f"You have {gr} guesses remaining."
 
+HARD_MODE_TEXT = """
+Hard mode: letters revealed by your last guess
+must be used in the next one.
+"""
+
 LOSE_TEXT = """
 You ran out of guesses for the day. Come back tomorrow!
 """
@@ -38,8 +49,8 @@ You ran out of guesses for the day. Come back tomorrow!
 ## Game Client
 
 class WordGuessClient:
-    def __init__(self):
-        pass
+    def __init__(self, variant = WordGuess.DEFAULT_VARIANT):
+        self.variant = variant
 
     def start_game(self, client, _):
 
@@ -51,7 +62,9 @@ class WordGuessClient:
         today = datetime.today().date()
 
         print(STARTUP_MESSAGE(message.num_characters, today))
-        
+        if WordGuess.VARIANTS[self.variant].hard_mode:
+            print(HARD_MODE_TEXT)
+
         if is_winner:
             print(WIN_TEXT(guesses_remaining))
         elif guesses_remaining > 0:
@@ -85,9 +98,25 @@ class WordGuessClient:
             if not is_winner:
                 print(LOSE_TEXT)
 
-        except KeyboardInterrupt:
+        except (KeyboardInterrupt, EOFError):
             pass
 
+def parse_args():
+    # argparse is slow to import, and most
+    # players run the client without options
+    if len(sys.argv) == 1:
+        return WordGuess.DEFAULT_VARIANT, WordGuess.ADDRESS
+    import argparse
+    parser = argparse.ArgumentParser(description="WordGuess Game Client")
+    parser.add_argument(
+        "--variant", type=str, default=WordGuess.DEFAULT_VARIANT, choices=WordGuess.VARIANTS,
+        help="Which game to play."
+    )
+    parser.add_argument("--address", type=str, default=WordGuess.ADDRESS, help="Game socket to connect to.")
+    args = parser.parse_args()
+    return args.variant, args.address
+
 if __name__ == "__main__":
-    w = WordGuessClient()
-    run_simple_client(WordGuess.ADDRESS, w.start_game)
+    variant, address = parse_args()
+    w = WordGuessClient(variant)
+    run_simple_client(address, w.start_game, session_file=SESSION_LOCATION, game=variant)
@@ -0,0 +1,395 @@
+"""
+WordGuess Dictionary Index
+Author: Brandon Rozek
+
+Loads the word list once per process and
+keeps it in forms that are cheap to query:
+a frozenset for membership tests and a
+compact array of words for each length.
+
+For large word lists, build words.dict from
+words.txt. It holds the words of each length
+sorted and front coded in blocks, and is
+memory-mapped instead of read, so loading it
+takes next to no time however big it is. It's
+used instead of words.txt as long as it's newer.
+
+Usage
+=====
+python dictionary.py build
+python dictionary.py build --words words.fr.txt --output words.fr.dict
+python dictionary.py check
+"""
+from array import array
+from bisect import bisect_right
+from collections import defaultdict
+from functools import lru_cache
+from typing import Iterable
+import os
+import struct
+import sys
+
+SERVER_FOLDER = os.path.dirname(os.path.abspath(__file__))
+WORDS_LOCATION = f"{SERVER_FOLDER}/words.txt"
+CACHE_FOLDER = f"{SERVER_FOLDER}/cache"
+
+# Packed dictionary, see write_packed for the layout
+MAGIC = b"WGD1"
+FILE_HEADER = struct.Struct("<4sII")
+BUCKET_HEADER = struct.Struct("<IIIIIB3x")
+# Words per front coded block. Larger blocks
+# are smaller on disk but slower to search.
+BLOCK_SIZE = 16
+# Prefix and suffix lengths usually fit in a byte together,
+# this prefix length says they follow in a byte each instead
+LONG_PREFIX = 15
+
+class WordList:
+    """
+    Words of a single length packed into one
+    string in sorted order, so membership can be
+    checked by bisection.
+
+    Indexing follows the order the words were
+    given in (the order of words.txt) since the
+    word of the day is picked by position.
+    """
+    def __init__(self, length: int, words: Iterable[str]):
+        words = list(words)
+        ranked = sorted(range(len(words)), key=words.__getitem__)
+        self.length = length
+        self.data = "".join(words[i] for i in ranked)
+        # position in original order -> slot in sorted data
+        self.order = array("I", [0]) * len(words)
+        for slot, i in enumerate(ranked):
+            self.order[i] = slot
+
+    def __len__(self):
+        return len(self.order)
+
+    def __getitem__(self, i: int) -> str:
+        return self.sorted_word(self.order[i])
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+    def __contains__(self, word: str) -> bool:
+        if len(word) != self.length:
+            return False
+        lo, hi = 0, len(self.order)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.sorted_word(mid) < word:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo < len(self.order) and self.sorted_word(lo) == word
+
+    def sorted_word(self, slot: int) -> str:
+        start = slot * self.length
+        return self.data[start:start + self.length]
+
+class WordIndex:
+    """
+    Every word of the dictionary, built once
+    and shared between game configurations
+    regardless of their word length.
+    """
+    def __init__(self, words: Iterable[str]):
+        buckets = defaultdict(list)
+        for word in words:
+            buckets[len(word)].append(word)
+        self.words = frozenset(w for bucket in buckets.values() for w in bucket)
+        self.buckets = {n: WordList(n, ws) for n, ws in buckets.items()}
+
+    @classmethod
+    def from_file(cls, location: str = WORDS_LOCATION):
+        with open(location, "r") as file:
+            return cls(l for l in file.read().splitlines() if len(l) > 0)
+
+    def __contains__(self, word: str) -> bool:
+        return word in self.words
+
+    def __len__(self):
+        return len(self.words)
+
+    def words_of_length(self, length: int) -> WordList:
+        bucket = self.buckets.get(length)
+        if bucket is None:
+            bucket = WordList(length, [])
+        return bucket
+
+class PackedWordList:
+    """
+    Same as WordList, read from a memory-mapped
+    words.dict. Words are stored sorted, in blocks
+    that start with a whole word followed by the
+    rest as the length of the prefix they share
+    with the word before and what comes after it.
+    """
+    def __init__(self, data, length: int, count: int, index: int, blocks: int, order: int, width: int):
+        self.data = data
+        self.length = length
+        self.blocks = blocks
+        # block -> offset from blocks
+        self.index = int_view(data, index, -(-count // BLOCK_SIZE), "I")
+        # position in original order -> slot in sorted data
+        self.order = int_view(data, order, count, "H" if width == 2 else "I")
+        self.first_words = None
+
+    def __len__(self):
+        return len(self.order)
+
+    def __getitem__(self, i: int) -> str:
+        block, offset = divmod(self.order[i], BLOCK_SIZE)
+        *_, word = self.block_words(block, offset + 1)
+        return word.decode()
+
+    def __iter__(self):
+        # Decoding every word once in sorted order is
+        # much cheaper than decoding each on its own
+        words = []
+        for block in range(len(self.index)):
+            words.extend(self.block_words(block))
+        return (words[slot].decode() for slot in self.order)
+
+    def __contains__(self, word: str) -> bool:
+        if len(word) != self.length or not self.index:
+            return False
+        word = word.encode()
+        if self.first_words is None:
+            # A copy of the first word of every block, made on
+            # the first search rather than slowing down the load
+            self.first_words = [self.first_word(block) for block in range(len(self.index))]
+        # Only the block starting at or before the word can hold it
+        block = bisect_right(self.first_words, word)
+        if block == 0:
+            return False
+        # Words in a block are sorted, so stop at the first one past it
+        for found in self.block_words(block - 1):
+            if found >= word:
+                return found == word
+        return False
+
+    def first_word(self, block: int) -> bytes:
+        start = self.blocks + self.index[block]
+        return self.data[start + 1:start + 1 + self.data[start]]
+
+    def block_words(self, block: int, count: int = BLOCK_SIZE):
+        """
+        Decode the first count words of a block, one at a time.
+        """
+        # The last block can be short
+        count = min(count, len(self.order) - block * BLOCK_SIZE)
+        start = self.blocks + self.index[block]
+        # Reading the block in one go beats going
+        # through the memory map for every byte
+        data = self.data[start:start + count * (self.length * 4 + 3)]
+        size = data[0]
+        word = data[1:1 + size]
+        position = 1 + size
+        yield word
+        for _ in range(count - 1):
+            shared, size = divmod(data[position], 16)
+            position += 1
+            if shared == LONG_PREFIX:
+                shared, size = data[position], data[position + 1]
+                position += 2
+            word = word[:shared] + data[position:position + size]
+            position += size
+            yield word
+
+class PackedIndex:
+    """
+    Same as WordIndex, read from a words.dict
+    built by write_packed. Membership is
+    checked in the bucket of the word's length.
+    """
+    def __init__(self, location: str):
+        import mmap
+        with open(location, "rb") as file:
+            self.data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, _, buckets = FILE_HEADER.unpack_from(self.data)
+        if magic != MAGIC:
+            raise ValueError(f"{location} is not a packed dictionary")
+        validate(location, self.data)
+
+        self.buckets = dict()
+        for i in range(buckets):
+            length, *bucket = BUCKET_HEADER.unpack_from(self.data, FILE_HEADER.size + i * BUCKET_HEADER.size)
+            self.buckets[length] = PackedWordList(self.data, length, *bucket)
+
+    def __contains__(self, word: str) -> bool:
+        bucket = self.buckets.get(len(word))
+        return bucket is not None and word in bucket
+
+    def __len__(self):
+        return sum(len(bucket) for bucket in self.buckets.values())
+
+    def words_of_length(self, length: int):
+        bucket = self.buckets.get(length)
+        if bucket is None:
+            bucket = WordList(length, [])
+        return bucket
+
+def int_view(data, offset: int, count: int, typecode: str):
+    """
+    Array of count little-endian unsigned ints
+    at offset, without copying where possible.
+    """
+    size = array(typecode).itemsize
+    if sys.byteorder == "little":
+        return memoryview(data)[offset:offset + size * count].cast(typecode)
+    values = array(typecode, data[offset:offset + size * count])
+    values.byteswap()
+    return values
+
+def write_packed(words: Iterable[str], location: str):
+    """
+    File layout, all numbers little-endian:
+    MAGIC, CRC-32 of everything after this header,
+    number of buckets, then per bucket: word length,
+    number of words, where its block index, blocks
+    and order are and the bytes per entry of the
+    order. The block index holds the offset of each
+    block from the first, the order the sorted slot
+    of each word in the original order, and blocks
+    the UTF-8 front coded words.
+    """
+    import zlib
+    buckets = defaultdict(list)
+    for word in words:
+        buckets[len(word)].append(word)
+
+    sections = []
+    headers = []
+    offset = FILE_HEADER.size + len(buckets) * BUCKET_HEADER.size
+    for length in sorted(buckets):
+        bucket = buckets[length]
+        ranked = sorted(range(len(bucket)), key=bucket.__getitem__)
+        order = array("H" if len(bucket) <= 0x10000 else "I", [0]) * len(bucket)
+        for slot, i in enumerate(ranked):
+            order[i] = slot
+
+        index = array("I")
+        blocks = bytearray()
+        previous = b""
+        for slot, i in enumerate(ranked):
+            word = bucket[i].encode()
+            if len(word) > 255:
+                raise ValueError(f"{bucket[i]} is too long")
+            if slot % BLOCK_SIZE == 0:
+                index.append(len(blocks))
+                blocks.append(len(word))
+                blocks += word
+            else:
+                shared = 0
+                while shared < min(len(word), len(previous)) and word[shared] == previous[shared]:
+                    shared += 1
+                size = len(word) - shared
+                if shared < LONG_PREFIX and size < 16:
+                    blocks.append(shared * 16 + size)
+                else:
+                    blocks += bytes([LONG_PREFIX * 16, shared, size])
+                blocks += word[shared:]
+            previous = word
+        # Keep the arrays of the next bucket aligned
+        blocks += bytes(-len(blocks) % 4)
+
+        if sys.byteorder == "big":
+            index.byteswap()
+            order.byteswap()
+        width = order.itemsize
+        index, order = index.tobytes(), order.tobytes()
+        # A short order can leave the blocks unaligned
+        order += bytes(-len(order) % 4)
+        headers.append(BUCKET_HEADER.pack(
+            length, len(bucket), offset, offset + len(index) + len(order), offset + len(index), width
+        ))
+        sections += [index, order, bytes(blocks)]
+        offset += len(index) + len(order) + len(blocks)
+
+    body = b"".join(headers + sections)
+    partial = f"{location}.partial"
+    with open(partial, "wb") as file:
+        file.write(FILE_HEADER.pack(MAGIC, zlib.crc32(body), len(buckets)))
+        file.write(body)
+    os.replace(partial, location)
+
+def validate(location: str, data):
+    """
+    Check the file against its checksum. The result is
+    kept under cache/ by the file's size, inode and
+    modification time, so an unchanged file is only
+    read through once rather than on every start.
+    """
+    import json
+    import zlib
+    stat = os.stat(location)
+    key = [stat.st_size, stat.st_ino, stat.st_mtime_ns]
+    _, checksum, _ = FILE_HEADER.unpack_from(data)
+    import hashlib
+    path = os.path.abspath(location).encode()
+    cache = f"{CACHE_FOLDER}/{os.path.basename(location)}-{hashlib.blake2b(path, digest_size=6).hexdigest()}.valid"
+    try:
+        with open(cache, "r") as file:
+            if json.load(file) == [key, checksum]:
+                return
+    except (OSError, ValueError):
+        pass
+
+    if zlib.crc32(memoryview(data)[FILE_HEADER.size:]) != checksum:
+        raise ValueError(f"{location} is corrupt, rebuild it with python dictionary.py build")
+    try:
+        os.makedirs(CACHE_FOLDER, exist_ok=True)
+        with open(cache, "w") as file:
+            json.dump([key, checksum], file)
+    except OSError:
+        # Only costs a read through on the next start
+        pass
+
+def packed_location(location: str) -> str:
+    return os.path.splitext(location)[0] + ".dict"
+
+@lru_cache(maxsize=None)
+def load_index(location: str = WORDS_LOCATION):
+    """
+    Return the dictionary index for a word list,
+    reading the file only the first time. A packed
+    dictionary next to a word list is used instead
+    if it was built after the list last changed.
+    """
+    if location.endswith(".dict"):
+        return PackedIndex(location)
+    packed = packed_location(location)
+    try:
+        if os.stat(packed).st_mtime_ns >= os.stat(location).st_mtime_ns:
+            return PackedIndex(packed)
+    except OSError:
+        pass
+    return WordIndex.from_file(location)
+
+if __name__ == "__main__":
+    import argparse
+    import time
+    parser = argparse.ArgumentParser(description="Build and check packed WordGuess dictionaries")
+    parser.add_argument("command", choices=["build", "check"])
+    parser.add_argument("--words", type=str, default=WORDS_LOCATION, help="Word list, one word per line.")
+    parser.add_argument("--output", type=str, help="Packed dictionary, by default next to the word list.")
+    args = parser.parse_args()
+    output = args.output if args.output is not None else packed_location(args.words)
+
+    if args.command == "build":
+        with open(args.words, "r") as file:
+            words = [l for l in file.read().splitlines() if len(l) > 0]
+        write_packed(words, output)
+        print(f"Wrote {len(words)} words to {output} ({os.path.getsize(output)} bytes)")
+        sys.exit(0)
+
+    start = time.perf_counter()
+    index = PackedIndex(output)
+    print(f"Loaded {output} in {1000 * (time.perf_counter() - start):.2f} ms")
+    expected = WordIndex.from_file(args.words)
+    for length in sorted(set(index.buckets) | set(expected.buckets)):
+        same = list(index.words_of_length(length)) == list(expected.words_of_length(length))
+        print(f"{length:>3} letters: {len(index.words_of_length(length)):>8} words{'' if same else ' (differs from the word list)'}")
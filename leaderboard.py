@@ -5,25 +5,130 @@ Author: Brandon Rozek
 from datetime import datetime
 import argparse
 import sqlite3
+import sys
 
 from wordguess import WordGuess
 
+def combine_results(con, locations):
+    """
+    Attach the results of other shards and shadow the
+    tables with views over all of them. A player moved
+    to another shard has their totals added up, and
+    their current streak taken from where they last played.
+    """
+    shards = ["main"]
+    for i, location in enumerate(locations):
+        con.execute(f"ATTACH DATABASE ? AS shard{i}", (f"file:{location}?mode=ro",))
+        shards.append(f"shard{i}")
+    con.executescript(f"""
+        CREATE TEMP VIEW scores AS
+            {" UNION ALL ".join(f"SELECT * FROM {shard}.scores" for shard in shards)};
+        CREATE TEMP VIEW shard_totals AS
+            {" UNION ALL ".join(f"SELECT * FROM {shard}.user_totals" for shard in shards)};
+        CREATE TEMP VIEW user_totals AS
+            SELECT user, variant, sum(games) AS games, sum(total_score) AS total_score,
+                max(best_score) AS best_score,
+                (SELECT current_streak FROM shard_totals AS latest
+                    WHERE latest.user = t.user AND latest.variant = t.variant
+                    ORDER BY last_date DESC LIMIT 1) AS current_streak,
+                max(longest_streak) AS longest_streak, max(last_date) AS last_date
+            FROM shard_totals AS t GROUP BY user, variant;
+    """)
+
+def daily_scores(con, date, variant, top=None):
+    return con.execute(
+        "SELECT user, score FROM scores WHERE variant = ? AND date = ? ORDER BY score DESC LIMIT ?",
+        (variant, date, -1 if top is None else top)
+    ).fetchall()
+
+def all_time_totals(con, variant, top=None):
+    return con.execute(
+        "SELECT user, total_score, games, best_score FROM user_totals "
+        "WHERE variant = ? ORDER BY total_score DESC LIMIT ?",
+        (variant, -1 if top is None else top)
+    ).fetchall()
+
+def streaks(con, today, variant, top=None):
+    # A streak is only current if the user
+    # won today or yesterday
+    return con.execute(
+        "SELECT user, longest_streak, "
+        "CASE WHEN last_date >= date(?, '-1 day') THEN current_streak ELSE 0 END "
+        "FROM user_totals WHERE variant = ? ORDER BY longest_streak DESC LIMIT ?",
+        (today, variant, -1 if top is None else top)
+    ).fetchall()
+
+def user_history(con, user, variant, top=None):
+    return con.execute(
+        "SELECT date, score FROM scores WHERE user = ? AND variant = ? ORDER BY date DESC LIMIT ?",
+        (user, variant, -1 if top is None else top)
+    ).fetchall()
+
+def range_totals(con, start, end, variant, top=None):
+    return con.execute(
+        "SELECT user, sum(score) AS total, count(*) FROM scores "
+        "WHERE variant = ? AND date BETWEEN ? AND ? GROUP BY user ORDER BY total DESC LIMIT ?",
+        (variant, start, end, -1 if top is None else top)
+    ).fetchall()
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Leaderboard for WordGuess Game")
     parser.add_argument("--date", type=str, help="Filter scores by date listed in YYYY-MM-DD format.")
+    parser.add_argument("--top", type=int, help="Only show the first N entries.")
+    parser.add_argument(
+        "--variant", type=str, default=WordGuess.DEFAULT_VARIANT, choices=WordGuess.VARIANTS,
+        help="Game to show scores for."
+    )
+    parser.add_argument(
+        "--results", type=str, nargs="+", default=[WordGuess.RESULTS_LOCATION],
+        help="Results to read, such as those of every shard behind a router (see router.py)."
+    )
+    view = parser.add_mutually_exclusive_group()
+    view.add_argument("--all-time", action="store_true", help="Show total scores across every day.")
+    view.add_argument("--streaks", action="store_true", help="Show the longest winning streaks.")
+    view.add_argument("--user", type=str, help="Show the score history of a user.")
+    view.add_argument(
+        "--range", type=str, nargs=2, metavar=("START", "END"),
+        help="Show total scores between two dates (inclusive) in YYYY-MM-DD format."
+    )
     args = vars(parser.parse_args())
+    TOP = args.get("top")
+    VARIANT = args["variant"]
 
     # If not specified, then use today's date
     DATE = args.get("date")
     if DATE is None:
         DATE = str(datetime.today().date())
 
-    con = sqlite3.connect(WordGuess.RESULTS_LOCATION)
+    # Players only need to read the results
+    con = sqlite3.connect(f"file:{args['results'][0]}?mode=ro", uri=True)
     try:
-        cur = con.cursor()
-        res = cur.execute(f"SELECT user, score FROM scores WHERE date = '{DATE}' ORDER BY score DESC")
-        print(f"High scores for date '{DATE}'")
-        for username, score in res.fetchall():
-              print(username, score)
+        if len(args["results"]) > 1:
+            combine_results(con, args["results"][1:])
+        if args["all_time"]:
+            print("All-time high scores (total, games, best)")
+            for username, total, games, best in all_time_totals(con, VARIANT, TOP):
+                print(username, total, games, best)
+        elif args["streaks"]:
+            print("Winning streaks (longest, current)")
+            for username, longest, current in streaks(con, DATE, VARIANT, TOP):
+                print(username, longest, current)
+        elif args["user"] is not None:
+            print(f"Scores for '{args['user']}'")
+            for date, score in user_history(con, args["user"], VARIANT, TOP):
+                print(date, score)
+        elif args["range"] is not None:
+            start, end = args["range"]
+            print(f"High scores from '{start}' to '{end}' (total, games)")
+            for username, total, games in range_totals(con, start, end, VARIANT, TOP):
+                print(username, total, games)
+        else:
+            print(f"High scores for date '{DATE}'")
+            for username, score in daily_scores(con, DATE, VARIANT, TOP):
+                print(username, score)
+    except sqlite3.OperationalError as e:
+        # Summary tables are created when the server starts
+        print("Cannot read results:", e)
+        sys.exit(1)
     finally:
         con.close()
@@ -0,0 +1,407 @@
+"""
+WordGuess Load Generator
+Author: Brandon Rozek
+
+Starts server.py on a temporary socket with its
+own state and results, then has simulated players
+log in and play full games against it. Reports
+throughput, latency and the server's peak memory
+and thread count, and can save them as JSON to
+compare against another version.
+
+Every game is played by a different user so that
+each one starts fresh. The players log in with
+session tokens signed by the server's key, which
+is the only way for one unix user to act as many.
+
+With --shards, it starts that many servers on
+loopback TCP ports behind router.py instead, and
+the peak memory and threads are the router's.
+
+With --hammer, every player plays the same user's
+game at once, guessing as fast as they can, one
+user per round of games. It reports how many
+guesses the server took past the ones allowed,
+which should be none.
+
+Usage
+=====
+python loadgen.py --clients 50 --games 20 --think 200 --json after.json --compare before.json
+python loadgen.py --shards 3 --mode async
+python loadgen.py --hammer --clients 100 --games 20
+"""
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from threading import Event, Thread
+from time import perf_counter, sleep
+import argparse
+import json
+import os
+import platform
+import random
+import signal
+import socket
+import subprocess
+import sys
+
+from pubnix import (
+    PROTOCOL_VERSION,
+    ConnectionClosed,
+    ProtocolException,
+    StartMessage,
+    issue_session,
+    login,
+    receive_message,
+    send_message,
+    start_client
+)
+from dictionary import load_index
+from loadtest import percentile, process_stats, wait_until_listening
+from schedule import SCHEDULE_EPOCH
+from server import WordGuessServer
+from state import StateStore
+from wordguess import WordGuess
+
+SERVER_FOLDER = Path(__file__).parent.absolute()
+SEED = 12345
+SAMPLE_INTERVAL = 0.1
+
+# Metrics shown when comparing against older results
+HIGHER_IS_BETTER = ("connections_per_second", "guesses_per_second")
+LOWER_IS_BETTER = (
+    "auth_p50_ms", "auth_p99_ms", "guess_p50_ms", "guess_p99_ms", "peak_threads", "peak_rss_kib"
+)
+
+class Monitor(Thread):
+    """
+    Samples the server's thread count while
+    the load runs. Peak RSS comes from the
+    kernel's high water mark.
+    """
+    def __init__(self, pid):
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.stopped = Event()
+        self.peak_threads = 0
+        self.peak_rss = 0
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                stats = process_stats(self.pid)
+            except OSError:
+                break
+            self.peak_threads = max(self.peak_threads, stats["Threads"])
+            self.peak_rss = stats["VmHWM"]
+            self.stopped.wait(SAMPLE_INTERVAL)
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+def play(address, user, session_file, words, wotd, args, rng, record):
+    """
+    One full game as user. Latencies are
+    added to record as they are measured.
+    """
+    start = perf_counter()
+    with start_client(address) as client:
+        _, success = login(client, peercred=False, session_file=session_file, user=user)
+        if not success:
+            record["errors"] += 1
+            return
+        send_message(client, StartMessage(version=PROTOCOL_VERSION, codec=args.codec, game=args.variant))
+        game = receive_message(client, WordGuess.GameStartMessage)
+        record["auth"].append(perf_counter() - start)
+
+        winner = rng.random() < args.win_rate
+        remaining = game.guesses_remaining
+        while remaining > 0:
+            if args.think > 0:
+                sleep(rng.uniform(0, 2 * args.think / 1000))
+            word = wotd if winner and remaining == 1 else rng.choice(words)
+            sent = perf_counter()
+            send_message(client, WordGuess.GuessMessage(word))
+            response = receive_message(client, WordGuess.GuessResponseMessage)
+            record["guesses"].append(perf_counter() - sent)
+            remaining = response.guesses_remaining
+            if response.winner:
+                break
+    record["games"] += 1
+
+def hammer(address, user, session_file, words, args, rng, record):
+    """
+    Guess as fast as possible in a game that other
+    players are making guesses in too. Counts the
+    guesses the server took.
+    """
+    start = perf_counter()
+    with start_client(address) as client:
+        _, success = login(client, peercred=False, session_file=session_file, user=user)
+        if not success:
+            record["errors"] += 1
+            return
+        send_message(client, StartMessage(version=PROTOCOL_VERSION, codec=args.codec, game=args.variant))
+        game = receive_message(client, WordGuess.GameStartMessage)
+        record["auth"].append(perf_counter() - start)
+
+        remaining = game.guesses_remaining
+        try:
+            while remaining > 0:
+                sent = perf_counter()
+                send_message(client, WordGuess.GuessMessage(rng.choice(words)))
+                response = receive_message(client, WordGuess.GuessResponseMessage)
+                record["guesses"].append(perf_counter() - sent)
+                record["accepted"] += response.valid
+                remaining = response.guesses_remaining
+        except (BrokenPipeError, ConnectionClosed, ConnectionResetError):
+            # The server hangs up once another
+            # player has ended the game
+            pass
+    record["games"] += 1
+
+def run_clients(address, folder, key, wotd, worker, args):
+    """
+    Entrypoint of a client process, which runs
+    its share of the players on threads.
+    """
+    words = list(load_index().words_of_length(WordGuess.VARIANTS[args.variant].word_length))
+    # Players who hammer never win, so that
+    # every game takes all its guesses
+    if args.hammer:
+        words.remove(wotd)
+
+    records = []
+    def client(index):
+        rng = random.Random(f"{worker}-{index}")
+        record = dict(auth=[], guesses=[], games=0, errors=0, accepted=0)
+        records.append(record)
+        for game in range(args.games):
+            if args.hammer:
+                user = f"bench-hammer-{game}"
+                session_file = f"{folder}/{user}-{worker}-{index}.session"
+            else:
+                user = f"bench-{worker}-{index}-{game}"
+                session_file = f"{folder}/{user}.session"
+            with open(session_file, "w") as file:
+                file.write(issue_session(key, user))
+            try:
+                if args.hammer:
+                    hammer(address, user, session_file, words, args, rng, record)
+                else:
+                    play(address, user, session_file, words, wotd, args, rng, record)
+            except (ProtocolException, OSError):
+                record["errors"] += 1
+
+    share = [i for i in range(args.clients) if i % args.processes == worker]
+    threads = [Thread(target=client, args=[i]) for i in share]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return records
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def start_shards(folder, address, key, args):
+    """
+    Start args.shards servers on loopback and a
+    router in front of them listening at address.
+    """
+    # A session ends on the shard a moment after the player
+    # sees it end, so a player's next game can overlap it
+    max_sessions = str(2 * max(args.clients, 1))
+    cluster = f"{folder}/cluster.json"
+    with open(cluster, "w") as file:
+        json.dump(dict(
+            seed=SEED, session_key=key.hex(), shard_key=os.urandom(32).hex(),
+            schedule_start=str(SCHEDULE_EPOCH)
+        ), file)
+
+    shards = [f"tcp://127.0.0.1:{free_port()}" for _ in range(args.shards)]
+    processes = []
+    for i, shard in enumerate(shards):
+        processes.append(subprocess.Popen(
+            [
+                sys.executable, "server.py", "--mode", args.mode, "--address", shard,
+                "--cluster", cluster, "--state", f"{folder}/shard{i}.db",
+                "--results", f"{folder}/shard{i}.results.db", "--analytics", f"{folder}/shard{i}.analytics.db",
+                "--workers", str(args.workers), "--max-sessions", max_sessions, "--no-rate-limits"
+            ],
+            cwd=SERVER_FOLDER,
+            stdout=subprocess.DEVNULL
+        ))
+    for process, shard in zip(processes, shards):
+        wait_until_listening(process, shard)
+
+    router = subprocess.Popen(
+        [
+            sys.executable, "router.py", "--cluster", cluster, "--address", address,
+            "--max-sessions", max_sessions, "--no-rate-limits", "--shards", *shards
+        ],
+        cwd=SERVER_FOLDER,
+        stdout=subprocess.DEVNULL
+    )
+    return router, processes
+
+def run(args):
+    with TemporaryDirectory() as folder:
+        address = f"{folder}/game.sock"
+        state = f"{folder}/state.db"
+        key = os.urandom(32)
+
+        if args.shards:
+            server, shards = start_shards(folder, address, key, args)
+        else:
+            # Fix the seed and session key before the server
+            # starts so that we know the words and can sign tokens
+            store = StateStore(state)
+            store.set_setting("seed", SEED)
+            store.set_setting("session_key", key.hex())
+            store.close()
+
+            server = subprocess.Popen(
+                [
+                    sys.executable, "server.py", "--mode", args.mode, "--address", address,
+                    "--state", state, "--results", f"{folder}/results.db", "--analytics", f"{folder}/analytics.db",
+                    "--workers", str(args.workers), "--max-sessions", str(max(args.clients, 1)),
+                    # Players here are as fast as the machine
+                    "--no-rate-limits"
+                ],
+                cwd=SERVER_FOLDER,
+                stdout=subprocess.DEVNULL
+            )
+            shards = []
+        try:
+            wait_until_listening(server, address)
+
+            # Once a game can start, the server has
+            # loaded its state and laid out the schedule
+            user = "bench-ready"
+            session_file = f"{folder}/{user}.session"
+            with open(session_file, "w") as file:
+                file.write(issue_session(key, user))
+            with start_client(address) as client:
+                login(client, peercred=False, session_file=session_file, user=user)
+                send_message(client, StartMessage(version=PROTOCOL_VERSION, game=args.variant))
+                receive_message(client, WordGuess.GameStartMessage)
+
+            if args.shards:
+                # Shards lay out the schedule from the
+                # cluster's start, which we chose
+                w = WordGuessServer.from_variant(SEED, args.variant)
+                w.load_schedule(SCHEDULE_EPOCH)
+            else:
+                store = StateStore(state)
+                w = WordGuessServer.from_variant(SEED, args.variant, store=store)
+                w.load_schedule(SCHEDULE_EPOCH)
+                store.close()
+            wotd = w.get_wotd(datetime.today().date())
+
+            monitor = Monitor(server.pid)
+            monitor.start()
+            start = perf_counter()
+            with ProcessPoolExecutor(args.processes) as pool:
+                futures = [
+                    pool.submit(run_clients, address, folder, key, wotd, worker, args)
+                    for worker in range(args.processes)
+                ]
+                records = [r for f in futures for r in f.result()]
+            elapsed = perf_counter() - start
+            monitor.stop()
+        finally:
+            for process in [server] + shards:
+                process.send_signal(signal.SIGINT)
+            for process in [server] + shards:
+                process.wait()
+
+    auth = [t for r in records for t in r["auth"]]
+    guesses = [t for r in records for t in r["guesses"]]
+    results = dict(
+        games=sum(r["games"] for r in records),
+        errors=sum(r["errors"] for r in records),
+        elapsed=elapsed,
+        connections_per_second=len(auth) / elapsed,
+        guesses_per_second=len(guesses) / elapsed,
+        auth_p50_ms=1000 * percentile(auth, 0.5) if auth else None,
+        auth_p99_ms=1000 * percentile(auth, 0.99) if auth else None,
+        guess_p50_ms=1000 * percentile(guesses, 0.5) if guesses else None,
+        guess_p99_ms=1000 * percentile(guesses, 0.99) if guesses else None,
+        peak_threads=monitor.peak_threads,
+        peak_rss_kib=monitor.peak_rss,
+    )
+    if args.hammer:
+        allowed = args.games * WordGuess.VARIANTS[args.variant].guesses_allowed
+        results["extra_guesses"] = sum(r["accepted"] for r in records) - allowed
+    return results
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=SERVER_FOLDER,
+            capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(results, location):
+    """
+    Print the change in each metric since
+    the results saved at location.
+    """
+    with open(location, "r") as file:
+        before = json.load(file)["results"]
+    print(f"Compared to {location}")
+    for name in HIGHER_IS_BETTER + LOWER_IS_BETTER:
+        value, old = results.get(name), before.get(name)
+        if value is None or not old:
+            continue
+        change = 100 * (value - old) / old
+        worse = change < 0 if name in HIGHER_IS_BETTER else change > 0
+        flag = "  (worse)" if worse and abs(change) >= 5 else ""
+        print(f"  {name:<24} {old:>12.2f} -> {value:>12.2f} {change:>+8.1f}%{flag}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load generator for the WordGuess server")
+    parser.add_argument("--mode", choices=["thread", "async", "pool"], default="thread", help="Server mode to test.")
+    parser.add_argument("--clients", type=int, default=50, help="Players connected at the same time.")
+    parser.add_argument("--games", type=int, default=10, help="Games each player plays, one after another.")
+    parser.add_argument("--think", type=float, default=100, help="Average think time between guesses in ms.")
+    parser.add_argument("--win-rate", type=float, default=0.5, help="Fraction of games that end with a win.")
+    parser.add_argument(
+        "--variant", type=str, default=WordGuess.DEFAULT_VARIANT, choices=WordGuess.VARIANTS,
+        help="Game the players ask for."
+    )
+    parser.add_argument("--codec", choices=["json", "binary"], default="binary", help="Codec the players ask for.")
+    parser.add_argument("--processes", type=int, default=os.cpu_count(), help="Processes running the players.")
+    parser.add_argument("--workers", type=int, default=64, help="Worker threads in pool mode.")
+    parser.add_argument("--shards", type=int, default=0, help="Run this many servers behind router.py.")
+    parser.add_argument(
+        "--hammer", action="store_true",
+        help="Have every player guess in the same user's game at once, a new user each game."
+    )
+    parser.add_argument("--json", type=str, help="Save the results to this file.")
+    parser.add_argument("--compare", type=str, help="Compare against results saved by an earlier run.")
+    args = parser.parse_args()
+    args.processes = max(1, min(args.processes, args.clients))
+
+    results = run(args)
+    for name, value in results.items():
+        print(f"{name:<24} {value:>12.2f}" if isinstance(value, float) else f"{name:<24} {value!s:>12}")
+
+    if args.compare is not None:
+        compare(results, args.compare)
+
+    if args.json is not None:
+        with open(args.json, "w") as file:
+            json.dump(dict(
+                revision=git_revision(),
+                python=platform.python_version(),
+                settings={k: v for k, v in vars(args).items() if k not in ("json", "compare")},
+                results=results,
+            ), file, indent=2)
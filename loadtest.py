@@ -0,0 +1,192 @@
+"""
+WordGuess Load Test
+Author: Brandon Rozek
+
+Starts a game server on a temporary socket,
+holds many connections open at once, and
+reports the server's memory, thread count and
+guess latency for each server mode.
+
+Usage
+=====
+python loadtest.py --connections 1000 --modes thread async
+"""
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from time import perf_counter, sleep
+import argparse
+import asyncio
+import resource
+import signal
+import socket
+import subprocess
+import sys
+
+from pubnix import (
+    PROTOCOL_VERSION,
+    AsyncConnection,
+    StartMessage,
+    receive_message_async,
+    send_message_async,
+    tcp_address
+)
+from wordguess import WordGuess
+
+SERVER_FOLDER = Path(__file__).parent.absolute()
+
+# Invalid guesses get a response without
+# changing the state of the game.
+INVALID_GUESS = "zzzzz"
+
+def raise_file_limit():
+    _, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+def serve(args):
+    """
+    Entrypoint of the server process. Authentication
+    is turned off since every simulated player
+    runs as the same unix user.
+    """
+    from server import WordGuessServer
+    from pubnix import run_async_server, run_pool_server, run_simple_server
+
+    raise_file_limit()
+    w = WordGuessServer(seed=12345)
+    if args.mode == "async":
+        run_async_server(args.address, w.game_async, force_auth=False)
+    elif args.mode == "pool":
+        run_pool_server(args.address, w.game, force_auth=False, workers=args.workers, backlog=args.concurrency)
+    else:
+        run_simple_server(args.address, w.game, force_auth=False)
+
+def process_stats(pid):
+    """
+    Memory and thread usage of a process
+    as reported by /proc/<pid>/status.
+    """
+    stats = {}
+    with open(f"/proc/{pid}/status", "r") as file:
+        for line in file:
+            key, _, value = line.partition(":")
+            if key in ("VmRSS", "VmHWM", "Threads"):
+                stats[key] = int(value.split()[0])
+    return stats
+
+def wait_until_listening(process, address, interval=0.05):
+    """
+    Wait until a connection to address goes through. A
+    unix socket's file shows up a moment before it listens.
+    Gives up if process is given and exits first.
+    """
+    tcp = tcp_address(address)
+    while True:
+        if process is not None and process.poll() is not None:
+            sys.exit("Server exited before it started listening")
+        try:
+            if tcp is not None:
+                socket.create_connection(tcp).close()
+            else:
+                with socket.socket(socket.AF_UNIX) as sock:
+                    sock.connect(address)
+            return
+        except (ConnectionRefusedError, FileNotFoundError):
+            pass
+        sleep(interval)
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p * len(values)))]
+
+async def open_session(address, semaphore):
+    # Limit how many connects are in flight so
+    # we don't overrun the server's listen backlog
+    async with semaphore:
+        reader, writer = await asyncio.open_unix_connection(address)
+        connection = AsyncConnection(reader, writer)
+        await send_message_async(connection, StartMessage(version=PROTOCOL_VERSION))
+        await receive_message_async(connection, WordGuess.GameStartMessage)
+    return connection
+
+async def probe(connection, rounds, latencies):
+    for _ in range(rounds):
+        start = perf_counter()
+        await send_message_async(connection, WordGuess.GuessMessage(INVALID_GUESS))
+        await receive_message_async(connection, WordGuess.GuessResponseMessage)
+        latencies.append(perf_counter() - start)
+
+async def load(args, address, pid):
+    semaphore = asyncio.Semaphore(args.concurrency)
+    start = perf_counter()
+    connections = await asyncio.gather(
+        *(open_session(address, semaphore) for _ in range(args.connections))
+    )
+    connect_time = perf_counter() - start
+    idle = process_stats(pid)
+
+    latencies = []
+    await asyncio.gather(*(probe(c, args.rounds, latencies) for c in connections))
+    busy = process_stats(pid)
+
+    for connection in connections:
+        connection.writer.close()
+
+    return dict(
+        connect_time=connect_time,
+        idle_rss=idle["VmRSS"],
+        peak_rss=busy["VmHWM"],
+        threads=idle["Threads"],
+        p50=percentile(latencies, 0.5),
+        p99=percentile(latencies, 0.99),
+    )
+
+def run(args, mode):
+    with TemporaryDirectory() as folder:
+        address = f"{folder}/game.sock"
+        server = subprocess.Popen(
+            [
+                sys.executable, __file__, "--serve", "--mode", mode, "--address", address,
+                "--workers", str(args.workers), "--concurrency", str(args.concurrency)
+            ],
+            cwd=SERVER_FOLDER,
+            stdout=subprocess.DEVNULL
+        )
+        try:
+            wait_until_listening(server, address)
+            return asyncio.run(load(args, address, server.pid))
+        finally:
+            server.send_signal(signal.SIGINT)
+            server.wait()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test for the WordGuess server")
+    parser.add_argument("--connections", type=int, default=1000, help="Simultaneous connections to hold open.")
+    parser.add_argument("--rounds", type=int, default=10, help="Guesses timed per connection.")
+    parser.add_argument("--concurrency", type=int, default=64, help="Connection attempts in flight at once.")
+    parser.add_argument("--modes", nargs="+", default=["thread", "async"], choices=["thread", "async", "pool"])
+    parser.add_argument(
+        "--workers", type=int,
+        help="Worker threads in pool mode, by default one per connection as held connections never free a worker."
+    )
+    parser.add_argument("--serve", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--mode", help=argparse.SUPPRESS)
+    parser.add_argument("--address", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.workers is None:
+        args.workers = args.connections
+
+    if args.serve:
+        serve(args)
+        sys.exit(0)
+
+    raise_file_limit()
+    print(f"{'mode':<8} {'connect s':>10} {'idle RSS KiB':>13} {'peak RSS KiB':>13} {'threads':>8} {'p50 ms':>8} {'p99 ms':>8}")
+    for mode in args.modes:
+        r = run(args, mode)
+        print(
+            f"{mode:<8} {r['connect_time']:>10.2f} {r['idle_rss']:>13} {r['peak_rss']:>13} "
+            f"{r['threads']:>8} {r['p50'] * 1000:>8.2f} {r['p99'] * 1000:>8.2f}"
+        )
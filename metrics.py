@@ -0,0 +1,272 @@
+"""
+WordGuess Server Metrics
+Author: Brandon Rozek
+
+Counters, gauges and histograms that the server
+updates as it runs, and an admin socket that
+reports them in the Prometheus text format.
+Updating a metric only takes a lock and an
+addition, so they are cheap enough to leave on.
+
+The admin socket also controls a sampling
+profiler, which is off until asked for.
+It periodically records the stack of every
+thread and reports how often each was seen,
+one collapsed stack per line, ready for
+flamegraph.pl.
+
+Usage
+=====
+curl --unix-socket admin.sock http://localhost/metrics
+curl --unix-socket admin.sock http://localhost/profile/start
+curl --unix-socket admin.sock http://localhost/profile
+curl --unix-socket admin.sock http://localhost/profile/stop
+"""
+from bisect import bisect_left
+from collections import Counter as StackCounter
+from contextlib import contextmanager
+from threading import Event, Lock, Thread, get_ident
+from time import perf_counter
+import os
+import sys
+
+# Upper bounds in seconds
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1)
+SAMPLE_INTERVAL = 0.01 # seconds
+PROFILE_TOP = 50
+MAX_REQUEST_LEN = 1024
+
+METRICS = []
+
+class Counter:
+    """
+    Count of events, optionally split
+    by the value of one label.
+    """
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, label: str = None):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.values = dict()
+        self.lock = Lock()
+        METRICS.append(self)
+
+    def inc(self, value=None, amount=1):
+        with self.lock:
+            self.values[value] = self.values.get(value, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            values = dict(self.values)
+        if not values and self.label is None:
+            values[None] = 0
+        for value, count in sorted(values.items(), key=lambda v: str(v[0])):
+            yield self.name, self.labels(value), count
+
+    def labels(self, value, **extra):
+        labels = dict() if value is None else {self.label: value}
+        labels.update(extra)
+        if not labels:
+            return ""
+        return "{" + ",".join(f'{k}="{escape(str(v))}"' for k, v in labels.items()) + "}"
+
+class Gauge(Counter):
+    """
+    Value that goes up and down,
+    such as the number of sessions.
+    """
+    kind = "gauge"
+
+    def dec(self, value=None, amount=1):
+        self.inc(value, -amount)
+
+class Histogram(Counter):
+    """
+    Distribution of observed values
+    across fixed buckets.
+    """
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, buckets=LATENCY_BUCKETS):
+        super().__init__(name, help)
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        i = bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.sum += value
+
+    @contextmanager
+    def time(self):
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(perf_counter() - start)
+
+    def samples(self):
+        with self.lock:
+            counts = list(self.counts)
+            total = self.sum
+        cumulative = 0
+        for bound, count in zip(self.buckets + ("+Inf",), counts):
+            cumulative += count
+            yield f"{self.name}_bucket", self.labels(None, le=bound), cumulative
+        yield f"{self.name}_sum", "", total
+        yield f"{self.name}_count", "", cumulative
+
+def escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def render() -> str:
+    """
+    Every metric in the Prometheus
+    text exposition format.
+    """
+    lines = []
+    for metric in METRICS:
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        for name, labels, value in metric.samples():
+            lines.append(f"{name}{labels} {value}")
+    return "\n".join(lines) + "\n"
+
+##
+# Profiler
+##
+
+class Profiler:
+    """
+    Samples the stacks of all other threads
+    every interval seconds while running.
+    """
+    def __init__(self):
+        self.stacks = StackCounter()
+        self.samples = 0
+        self.lock = Lock()
+        self.stopped = Event()
+        self.thread = None
+
+    @property
+    def running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self, interval=SAMPLE_INTERVAL):
+        if self.running:
+            return
+        with self.lock:
+            self.stacks.clear()
+            self.samples = 0
+        self.stopped.clear()
+        self.thread = Thread(target=self.run, args=[interval], name="profiler", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def run(self, interval):
+        me = get_ident()
+        while not self.stopped.wait(interval):
+            frames = sys._current_frames()
+            with self.lock:
+                self.samples += 1
+                for thread, frame in frames.items():
+                    if thread != me:
+                        self.stacks[collapse(frame)] += 1
+
+    def report(self, top=PROFILE_TOP) -> str:
+        with self.lock:
+            lines = [f"# {self.samples} samples, running: {self.running}"]
+            for stack, count in self.stacks.most_common(top):
+                lines.append(f"{stack} {count}")
+        return "\n".join(lines) + "\n"
+
+def collapse(frame) -> str:
+    """
+    Stack as root;...;leaf with one
+    file:function entry per frame.
+    """
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{code.co_filename.rsplit('/', 1)[-1]}:{code.co_name}")
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+PROFILER = Profiler()
+
+##
+# Admin socket
+##
+
+def handle_command(command: str) -> str:
+    words = command.split()
+    if not words or words[0] == "metrics":
+        return render()
+    if words[0] == "profile":
+        action = words[1] if len(words) > 1 else "report"
+        if action == "start":
+            interval = float(words[2]) if len(words) > 2 else SAMPLE_INTERVAL
+            PROFILER.start(interval)
+            return "Profiler started\n"
+        if action == "stop":
+            PROFILER.stop()
+            return PROFILER.report()
+        if action == "report":
+            return PROFILER.report()
+    raise ValueError(f"Unknown command: {command}")
+
+def handle_admin(connection):
+    """
+    Answer one request, either a plain command
+    line such as "profile start" or an HTTP GET
+    where the path holds the command.
+    """
+    with connection:
+        request = connection.recv(MAX_REQUEST_LEN).decode(errors="replace")
+        line = request.split("\n", 1)[0].strip()
+        http = line.startswith("GET ")
+        if http:
+            line = line.split()[1].strip("/").replace("/", " ")
+
+        status = "200 OK"
+        try:
+            body = handle_command(line)
+        except ValueError as e:
+            status = "404 Not Found"
+            body = f"{e}\n"
+
+        if http:
+            body = (
+                f"HTTP/1.0 {status}\r\n"
+                "Content-Type: text/plain; version=0.0.4\r\n"
+                f"Content-Length: {len(body.encode())}\r\n\r\n"
+            ) + body
+        connection.sendall(body.encode())
+
+def run_admin_server(sock):
+    while True:
+        connection, _ = sock.accept()
+        connection.settimeout(5)
+        try:
+            handle_admin(connection)
+        except OSError:
+            pass
+
+def start_admin_server(sock):
+    """
+    Serve metrics and the profiler on a listening
+    unix socket that only our own user can use.
+    """
+    # 49536 = 'srw-------.'
+    os.chmod(sock.getsockname(), 49536)
+    thread = Thread(target=run_admin_server, args=[sock], name="admin", daemon=True)
+    thread.start()
+    return thread
@@ -10,37 +10,127 @@ machine.
 For authentication, we rely on challenge
 tokens and the unix permission system as
 both server and client run on the same 
-machine.
+machine. Clients that offer it can skip the
+challenge when the kernel reports (through
+SO_PEERCRED) that the process on the other
+end of the socket belongs to the user.
+
+Servers given a session key also hand out
+short-lived signed session tokens. Presenting
+one on the next connection logs the client in
+without a challenge.
+
+Messages are JSON documents. Since protocol
+version 2 each one is prefixed by its length
+as a 4 byte big-endian integer. Peers start
+out unframed and the client advertises its
+version in the StartMessage. Once the server
+replies with a framed message, both ends
+stay framed for the rest of the connection.
+The StartMessage can also ask for a compact
+binary codec, which the client switches to
+once the server replies in it.
+
+Servers can be started by systemd socket
+activation, in which case they listen on the
+socket they are given instead of making one.
+On SIGTERM they stop accepting and give active
+sessions time to finish. On SIGHUP they first
+start a new server process with their listening
+sockets, so it takes new connections while the
+old one drains.
+
+Addresses of the form tcp://host:port use TCP
+instead, optionally over TLS, for servers on other
+machines. Neither the kernel nor a challenge file
+can vouch for a user over TCP, so there the only
+way in is a session token.
 """
 from contextlib import contextmanager
-from dataclasses import dataclass, asdict
-from pathlib import Path
-from threading import Thread
-from typing import Union
-import binascii
+from dataclasses import dataclass, fields
+from functools import lru_cache
+from threading import Condition, Lock, Thread, current_thread, main_thread
+from typing import ForwardRef, List, Optional, Tuple, Union, get_args, get_origin
 import json
+import math
 import os
 import pwd
+import signal
 import sys
 import socket
+import struct
+import time
 
-__all__ = ['run_simple_server', 'run_simple_client']
+from metrics import Counter, Gauge
+
+__all__ = ['run_simple_server', 'run_async_server', 'run_pool_server', 'run_simple_client']
 
 MESSAGE_BUFFER_LEN = 1024
+MAX_MESSAGE_LEN = 1024 * 1024
+LEGACY_VERSION = 1
+PROTOCOL_VERSION = 2
+HEADER = struct.Struct("!I")
+# pid, uid, gid of a peer
+PEERCRED = struct.Struct("3i")
 TOKEN_LENGTH = 50
 TIMEOUT = 5 * 60 # 5 minutes
+MAX_SESSIONS = 4096
+WORKERS = 64
+QUEUE_SIZE = 128
+RETRY_AFTER = 30 # seconds
+SESSION_TTL = 30 * 60 # 30 minutes
+DRAIN_TIMEOUT = 60 # seconds
+# Logins a user can make per second, and in a burst
+LOGIN_RATE = 1
+LOGIN_BURST = 20
+# Buckets that have been full this long are forgotten
+RATE_LIMIT_IDLE = 60 # seconds
+# First descriptor of the sockets passed by systemd
+SD_LISTEN_FDS_START = 3
+# Name given to the sockets a server made itself when handing
+# them off, so its replacement knows to remove their files
+HANDOFF_NAME = "pubnix"
+
+SERVER_FOLDER = os.path.dirname(os.path.abspath(__file__))
+
+ACCEPTS = Counter("pubnix_accepts_total", "Connections accepted.")
+SESSIONS = Gauge("pubnix_sessions", "Connections currently being served.")
+AUTH_FAILURES = Counter("pubnix_auth_failures_total", "Failed logins by reason.", "reason")
+TCP_PREFIX = "tcp://"
+
+ERRORS_SENT = Counter("pubnix_errors_total", "Connections closed with an error, by reason.", "reason")
+TIMEOUTS = Counter("pubnix_timeouts_total", "Connections dropped after being idle.")
+DISCONNECTS = Counter("pubnix_disconnects_total", "Connections lost before the session ended.", "error")
+RATE_LIMITED = Counter("pubnix_rate_limited_total", "Requests turned away by a rate limit, by limit.", "limit")
 
-SERVER_FOLDER = Path(__file__).parent.absolute()
+# Listening sockets by the real path of their file
+# (or tcp://ip:port), and the paths that this
+# process has to remove
+LISTENERS = dict()
+OWNED = set()
+# Sockets passed down to this process, see inherited_sockets
+INHERITED = None
 
 ###
 # Server
 ###
 
-def run_simple_server(address, fn, force_auth=True):
+def run_simple_server(
+        address, fn, force_auth=True, session_key=None,
+        drain_timeout=DRAIN_TIMEOUT, tls=None, logins=None):
     """
     This function can act as the main entrypoint
     for the server. It takes a function that interacts
-    with a connected user (potentially authenticated)
+    with a connected user (potentially authenticated),
+    or a dictionary of them by game (see select_handler)
+
+    session_key: Secret used to sign session tokens.
+    Without it, no tokens are issued or accepted.
+    drain_timeout: Seconds that active sessions get
+    to finish once the server is told to stop
+    tls: SSLContext for serving over TLS, see server_tls
+    logins: RateLimiter of each user's logins, checked
+    before anything is written for a challenge
 
     Example
     =======
@@ -50,120 +140,846 @@ def run_simple_server(address, fn, force_auth=True):
         lambda connection, user: connection.sendall(f"Hello {user}".encode())
       )
     """
-    with start_server(address) as sock:
+    sessions = Sessions()
+    with start_server(address) as sock, stop_signals():
         print("Started server at", address)
+        notify("READY=1")
         try:
             while True:
                 connection, _ = sock.accept()
+                ACCEPTS.inc()
                 connection.settimeout(TIMEOUT)
-                t = Thread(target=thread_connection, args=[connection, force_auth, fn])
-                t.daemon = True # TODO: Implement graceful cleanup instead
+                connection = Connection(connection)
+                sessions.add(connection)
+                t = Thread(
+                    target=thread_connection,
+                    args=[connection, force_auth, fn, session_key, sessions, tls, logins]
+                )
+                # Sessions still going after the drain are cut off
+                t.daemon = True
                 t.start()
         except KeyboardInterrupt:
             print("Stopping server...")
+        except Shutdown as e:
+            drain(address, sessions, e.replaced, drain_timeout)
 
-def thread_connection(connection, force_auth, fn):
+def run_pool_server(
+        address, fn, force_auth=True, workers=WORKERS,
+        queue_size=QUEUE_SIZE, backlog=None, retry_after=RETRY_AFTER,
+        session_key=None, drain_timeout=DRAIN_TIMEOUT, tls=None, logins=None):
+    """
+    Same as run_simple_server, except that connections
+    are served by a fixed number of worker threads
+    fed through a bounded queue. When the queue is
+    full, new clients are told to retry after
+    retry_after seconds instead of waiting.
+
+    backlog: Length of the socket's listen queue
+    """
+    from queue import Empty, Full, Queue
+    pending = Queue(maxsize=queue_size)
+    # Both waiting and active connections, so
+    # that the drain serves the waiting ones too
+    sessions = Sessions()
+    threads = [
+        Thread(target=pool_worker, args=[pending, sessions, force_auth, fn, session_key, tls, logins])
+        for _ in range(workers)
+    ]
+    for t in threads:
+        t.start()
+
+    with start_server(address, backlog=backlog) as sock, stop_signals():
+        print("Started server at", address)
+        notify("READY=1")
+        try:
+            while True:
+                connection, _ = sock.accept()
+                ACCEPTS.inc()
+                connection.settimeout(TIMEOUT)
+                connection = Connection(connection)
+                sessions.add(connection)
+                try:
+                    pending.put_nowait(connection)
+                except Full:
+                    sessions.discard(connection)
+                    reject(connection, f"Server busy, retry in {retry_after} s", "busy")
+        except KeyboardInterrupt:
+            print("Stopping server...")
+        except Shutdown as e:
+            drain(address, sessions, e.replaced, drain_timeout)
+        finally:
+            # Turn away clients that are still waiting
+            while True:
+                try:
+                    reject(pending.get_nowait(), "Server is shutting down", "shutting_down")
+                except Empty:
+                    break
+
+            # Wake up workers blocked on their client
+            sessions.shutdown()
+
+            for _ in threads:
+                pending.put(None)
+            for t in threads:
+                t.join()
+
+def pool_worker(pending, sessions, force_auth, fn, session_key, tls, logins):
+    while True:
+        connection = pending.get()
+        if connection is None:
+            break
+        try:
+            thread_connection(connection, force_auth, fn, session_key, sessions, tls, logins)
+        except Exception as e:
+            # Keep the worker alive for the next client
+            print("Error serving connection:", repr(e))
+
+def reject(connection, content: str, reason: str):
+    """
+    Send an error to a client we won't
+    serve and close its connection.
+    """
+    try:
+        close_with_error(connection, content, reason)
+    except (ProtocolException, OSError):
+        pass
+    finally:
+        connection.close()
+
+def thread_connection(connection, force_auth, fn, session_key=None, sessions=None, tls=None, logins=None):
+    SESSIONS.inc()
     try:
+        if tls is not None:
+            # The handshake happens here rather
+            # than holding up the accept loop
+            connection.sock = tls.wrap_socket(connection.sock, server_side=True)
         user = None
         if force_auth:
-            user = authenticate(connection)
-        receive_message(connection, StartMessage)
-        fn(connection, user)
-    except (
-        ProtocolException,
-        BrokenPipeError,
-        TimeoutError,
-        ConnectionResetError) as e:
-        # Ignore as client can reconnect
+            user = authenticate(connection, session_key, logins)
+        start = receive_message(connection, StartMessage)
+        negotiate(connection, start)
+        handler = select_handler(fn, start)
+        if handler is None:
+            close_with_error(connection, f"Unknown game: {start.game}", "unknown_game")
+        handler(connection, user)
+    except ProtocolException:
+        # Errors we sent are counted in close_with_error
         pass
+    except TimeoutError:
+        TIMEOUTS.inc()
+    except (BrokenPipeError, ConnectionResetError) as e:
+        # Ignore as client can reconnect
+        DISCONNECTS.inc(type(e).__name__)
+    except OSError as e:
+        # Such as a failed TLS handshake
+        DISCONNECTS.inc(type(e).__name__)
     finally: # clean up the connection
+        SESSIONS.dec()
+        if sessions is not None:
+            sessions.discard(connection)
         if connection is not None:
             connection.close()
 
+def run_async_server(
+        address, fn, force_auth=True, max_sessions=MAX_SESSIONS,
+        idle_timeout=TIMEOUT, session_key=None, drain_timeout=DRAIN_TIMEOUT, tls=None, logins=None):
+    """
+    Same as run_simple_server, except that
+    connections are served as asyncio tasks
+    on a single thread. fn must be a coroutine
+    function and communicate through
+    send_message_async/receive_message_async.
+
+    idle_timeout: Seconds to wait on a message
+    before dropping the connection
+    max_sessions: Connections beyond this
+    are turned away with an error
+    """
+    # Clients never need asyncio, which is slow to import
+    import asyncio
+    with start_server(address) as sock:
+        print("Started server at", address)
+        notify("READY=1")
+        try:
+            asyncio.run(serve_async(
+                address, sock, fn, force_auth, max_sessions, idle_timeout, session_key, drain_timeout, tls, logins
+            ))
+        except KeyboardInterrupt:
+            print("Stopping server...")
+
+async def serve_async(
+        address, sock, fn, force_auth, max_sessions, idle_timeout, session_key, drain_timeout, tls, logins):
+    import asyncio
+    sessions = 0
+    tasks = set()
+
+    async def handle(reader, writer):
+        nonlocal sessions
+        connection = AsyncConnection(reader, writer, idle_timeout)
+        ACCEPTS.inc()
+        SESSIONS.inc()
+        sessions += 1
+        tasks.add(asyncio.current_task())
+        try:
+            if sessions > max_sessions:
+                await close_with_error_async(connection, "Server is at capacity, try again later", "at_capacity")
+            user = None
+            if force_auth:
+                user = await authenticate_async(connection, session_key, logins)
+            start = await receive_message_async(connection, StartMessage)
+            negotiate(connection, start)
+            handler = select_handler(fn, start)
+            if handler is None:
+                await close_with_error_async(connection, f"Unknown game: {start.game}", "unknown_game")
+            await handler(connection, user)
+        except ProtocolException:
+            pass
+        except (TimeoutError, asyncio.TimeoutError):
+            # Only the same class from Python 3.11 on
+            TIMEOUTS.inc()
+        except (BrokenPipeError, ConnectionResetError) as e:
+            # Ignore as client can reconnect
+            DISCONNECTS.inc(type(e).__name__)
+        except OSError as e:
+            # Such as a failed TLS handshake
+            DISCONNECTS.inc(type(e).__name__)
+        finally:
+            SESSIONS.dec()
+            sessions -= 1
+            tasks.discard(asyncio.current_task())
+            writer.close()
+
+    loop = asyncio.get_running_loop()
+    stopping = loop.create_future()
+    def stop(signum):
+        replaced = signum == signal.SIGHUP
+        if replaced and not replace_server():
+            return
+        if not stopping.done():
+            stopping.set_result(replaced)
+    if current_thread() is main_thread():
+        for signum in STOP_SIGNALS:
+            loop.add_signal_handler(signum, stop, signum)
+
+    if sock.family == socket.AF_UNIX:
+        server = await asyncio.start_unix_server(handle, sock=sock, ssl=tls)
+    else:
+        server = await asyncio.start_server(handle, sock=sock, ssl=tls)
+    async with server:
+        replaced = await stopping
+        if current_thread() is main_thread():
+            for signum in STOP_SIGNALS:
+                loop.remove_signal_handler(signum)
+            while_draining()
+        server.close()
+        stop_listening(address)
+        if not replaced:
+            notify("STOPPING=1")
+        print(f"Waiting up to {drain_timeout} s for {len(tasks)} sessions to finish")
+        if tasks:
+            _, unfinished = await asyncio.wait(tasks, timeout=drain_timeout)
+            # Progress is saved, so they can pick up
+            # where they left off on the new server
+            for task in unfinished:
+                task.cancel()
+            await asyncio.gather(*unfinished, return_exceptions=True)
+
+def select_handler(fn, start):
+    """
+    fn is either the function for every client, or
+    a dictionary of functions by the game asked for
+    in the StartMessage, where None is the default.
+    """
+    if callable(fn):
+        return fn
+    return fn.get(start.game)
+
 @contextmanager
-def start_server(address, allow_other=True):
+def start_server(address, allow_other=True, backlog=None):
     """
     Opens up a unix domain socket at the specified address
     and listens for connections.
 
     allow_other: Allow other users on the system to connect
     to the unix domain socket
+    backlog: Length of the listen queue, by default
+    the one chosen by socket.listen
+
+    A socket for the same address that was passed
+    down to this process is used instead.
     """
-    if os.path.exists(address):
-        print(f"{address} exists -- server already running")
-        sys.exit(1)
-    
-    # Create a unix domain socket
-    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-    sock.bind(address)
-    sock.listen()
+    key = listener_key(address)
+    sock, owned = inherited_sockets().pop(key, (None, False))
+    if sock is None:
+        tcp = tcp_address(address)
+        if tcp is not None:
+            sock = bind_tcp(address, tcp)
+        else:
+            if os.path.exists(address):
+                print(f"{address} exists -- server already running")
+                sys.exit(1)
+
+            # Create a unix domain socket
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.bind(address)
+            owned = True
 
-    if allow_other:
-        # 33279 = '-rwxrwxrwx.'
-        os.chmod(f"{SERVER_FOLDER}/game.sock", 33279)
-        if os.path.exists(f"{SERVER_FOLDER}/challenges"):
-            os.chmod(f"{SERVER_FOLDER}/challenges", 33279)
+            if allow_other:
+                # 33279 = '-rwxrwxrwx.'
+                os.chmod(address, 33279)
 
+        if backlog is None:
+            sock.listen()
+        else:
+            sock.listen(backlog)
+
+    if allow_other and os.path.exists(f"{SERVER_FOLDER}/challenges"):
+        os.chmod(f"{SERVER_FOLDER}/challenges", 33279)
+
+    LISTENERS[key] = sock
+    if owned and sock.family == socket.AF_UNIX:
+        OWNED.add(key)
     try:
         yield sock
     finally:
-        # Delete game.sock when finished
+        stop_listening(address)
+
+def tcp_address(address) -> Optional[Tuple[str, int]]:
+    """
+    Host and port of a tcp://host:port address,
+    or None for the path of a unix domain socket.
+    """
+    if not address.startswith(TCP_PREFIX):
+        return None
+    host, _, port = address[len(TCP_PREFIX):].rpartition(":")
+    # IPv6 addresses are written as tcp://[::1]:7000
+    return host.strip("[]"), int(port)
+
+def listener_key(address) -> str:
+    """
+    Name of the socket at address that stays the same
+    however the address is written, and that can be
+    found from the socket alone.
+    """
+    tcp = tcp_address(address)
+    if tcp is None:
+        return os.path.realpath(address)
+    sockaddr = socket.getaddrinfo(*tcp, type=socket.SOCK_STREAM, flags=socket.AI_PASSIVE)[0][4]
+    return f"{TCP_PREFIX}{sockaddr[0]}:{sockaddr[1]}"
+
+def bind_tcp(address, tcp):
+    family, _, _, _, sockaddr = socket.getaddrinfo(
+        *tcp, type=socket.SOCK_STREAM, flags=socket.AI_PASSIVE
+    )[0]
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    # Restart without waiting on connections
+    # from the last run to time out
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    try:
+        sock.bind(sockaddr)
+    except OSError:
+        sock.close()
+        print(f"{address} is in use -- server already running")
+        sys.exit(1)
+    return sock
+
+def is_local(connection) -> bool:
+    """
+    Whether the client is on this machine,
+    connected through a unix domain socket.
+    """
+    return connection.family == socket.AF_UNIX
+
+def server_tls(cert: str, key: Optional[str] = None):
+    """
+    SSLContext for serving TCP connections over TLS
+    with the certificate chain and key in the given
+    PEM files.
+    """
+    import ssl
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(cert, key)
+    return context
+
+def client_tls(ca: Optional[str] = None):
+    """
+    SSLContext for connecting over TLS, trusting
+    the certificates in ca, or the system's.
+    """
+    import ssl
+    return ssl.create_default_context(cafile=ca)
+
+def stop_listening(address):
+    """
+    Stop taking connections on the socket at address
+    and delete game.sock if it's ours. Clients keep
+    queueing on it while systemd or a replacement
+    server still holds it.
+    """
+    key = listener_key(address)
+    sock = LISTENERS.pop(key, None)
+    if key in OWNED:
+        OWNED.discard(key)
         os.unlink(address)
+    if sock is not None:
+        sock.close()
+
+##
+# Restarts
+##
+
+STOP_SIGNALS = (signal.SIGTERM, signal.SIGHUP)
+
+class Shutdown(Exception):
+    """
+    Raised in the main thread when the server is
+    told to stop, after it has handed off its
+    sockets if it's being replaced.
+    """
+    def __init__(self, replaced: bool):
+        super().__init__()
+        self.replaced = replaced
+
+class Sessions:
+    """
+    Connections being served, so that a stopping
+    server can wait for them to finish.
+    """
+    def __init__(self):
+        self.active = set()
+        self.changed = Condition()
+
+    def __len__(self):
+        with self.changed:
+            return len(self.active)
+
+    def add(self, connection):
+        with self.changed:
+            self.active.add(connection)
+
+    def discard(self, connection):
+        with self.changed:
+            self.active.discard(connection)
+            self.changed.notify_all()
+
+    def wait(self, timeout) -> bool:
+        with self.changed:
+            return self.changed.wait_for(lambda: not self.active, timeout)
+
+    def shutdown(self):
+        """
+        Wake up everything blocked on a connection.
+        """
+        with self.changed:
+            active = list(self.active)
+        for connection in active:
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+##
+# Rate limits
+##
+
+class RateLimiter:
+    """
+    Token bucket per key, usually a user. Each
+    bucket holds up to burst tokens and refills
+    at rate tokens per second.
+    """
+    def __init__(self, name: str, rate: float, burst: float):
+        self.name = name
+        self.rate = rate
+        self.burst = burst
+        # key -> [tokens, time they were counted]
+        self.buckets = dict()
+        self.lock = Lock()
+        self.pruned = time.monotonic()
+
+    def take(self, key, cost: float = 1) -> float:
+        """
+        Take cost tokens from key's bucket. Returns 0 if
+        there were enough, otherwise how many seconds
+        until there will be, leaving the bucket as is.
+        """
+        now = time.monotonic()
+        with self.lock:
+            if now - self.pruned > RATE_LIMIT_IDLE:
+                self.prune(now)
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                bucket = self.buckets[key] = [self.burst, now]
+            tokens = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+            if tokens >= cost:
+                bucket[0] = tokens - cost
+                return 0
+            bucket[0] = tokens
+        RATE_LIMITED.inc(self.name)
+        return (cost - tokens) / self.rate
+
+    def prune(self, now):
+        """
+        Forget buckets that have refilled, they
+        are the same as ones that were never made.
+        """
+        self.pruned = now
+        full = [
+            key for key, (tokens, counted) in self.buckets.items()
+            if tokens + (now - counted) * self.rate >= self.burst
+        ]
+        for key in full:
+            del self.buckets[key]
+
+def rate_limit_error(limit: str, wait: float) -> str:
+    return f"Too many {limit}, try again in {math.ceil(wait)} s"
+
+def on_stop_signal(signum, frame):
+    replaced = signum == signal.SIGHUP
+    if replaced and not replace_server():
+        return
+    while_draining()
+    raise Shutdown(replaced)
+
+def while_draining():
+    """
+    Another SIGTERM stops a draining server
+    right away, another SIGHUP is ignored.
+    """
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+
+@contextmanager
+def stop_signals():
+    """
+    Turn SIGTERM and SIGHUP into Shutdown while
+    serving. Signals only reach the main thread.
+    """
+    if current_thread() is not main_thread():
+        yield
+        return
+    previous = {signum: signal.signal(signum, on_stop_signal) for signum in STOP_SIGNALS}
+    try:
+        yield
+    finally:
+        for signum, handler in previous.items():
+            signal.signal(signum, handler)
+
+def drain(address, sessions, replaced, timeout):
+    """
+    Stop accepting and give active
+    sessions timeout seconds to finish.
+    """
+    stop_listening(address)
+    if not replaced:
+        notify("STOPPING=1")
+    print(f"Waiting up to {timeout} s for {len(sessions)} sessions to finish")
+    if not sessions.wait(timeout):
+        # Progress is saved, so they can pick up
+        # where they left off on the new server
+        sessions.shutdown()
+
+def inherited_sockets():
+    """
+    Listening sockets passed down by systemd socket
+    activation, or by a server handing off to this
+    one, by the real path of their file. Each comes
+    with whether this process has to remove the
+    file when it's done. See sd_listen_fds(3).
+    """
+    global INHERITED
+    if INHERITED is None:
+        INHERITED = dict()
+        # Keep them from our own children
+        count = int(os.environ.pop("LISTEN_FDS", 0))
+        pid = os.environ.pop("LISTEN_PID", None)
+        names = os.environ.pop("LISTEN_FDNAMES", "").split(":")
+        if pid == str(os.getpid()):
+            for i in range(count):
+                sock = socket.socket(fileno=SD_LISTEN_FDS_START + i)
+                sock.set_inheritable(False)
+                if sock.family == socket.AF_UNIX:
+                    owned = i < len(names) and names[i] == HANDOFF_NAME
+                    INHERITED[os.path.realpath(sock.getsockname())] = (sock, owned)
+                else:
+                    host, port = sock.getsockname()[:2]
+                    INHERITED[f"{TCP_PREFIX}{host}:{port}"] = (sock, False)
+    return INHERITED
+
+def hand_off(argv=None) -> int:
+    """
+    Start a new server, by default with the same
+    command as this one, passing it every listening
+    socket the way systemd would. The new server
+    removes the socket files that were ours when it
+    stops. Returns its process id.
+    """
+    import fcntl
+    if argv is None:
+        argv = [sys.executable] + sys.argv
+    paths = list(LISTENERS)
+    # Copies above the descriptors that the
+    # sockets are moved to in the new process
+    fds = [
+        fcntl.fcntl(LISTENERS[path].fileno(), fcntl.F_DUPFD_CLOEXEC, SD_LISTEN_FDS_START + len(paths))
+        for path in paths
+    ]
+    env = dict(
+        os.environ,
+        LISTEN_FDS=str(len(fds)),
+        LISTEN_FDNAMES=":".join(HANDOFF_NAME if path in OWNED else "inherited" for path in paths)
+    )
+    try:
+        # LISTEN_PID has to be the new process id, which
+        # the shell knows before it becomes the server
+        pid = os.posix_spawn(
+            "/bin/sh",
+            ["sh", "-c", 'export LISTEN_PID=$$; exec "$0" "$@"'] + argv,
+            env,
+            file_actions=[
+                (os.POSIX_SPAWN_DUP2, fd, SD_LISTEN_FDS_START + i) for i, fd in enumerate(fds)
+            ]
+        )
+    finally:
+        for fd in fds:
+            os.close(fd)
+    OWNED.clear()
+    return pid
+
+def replace_server() -> bool:
+    """
+    Hand off to a new server, returning whether
+    it started. systemd follows the new process
+    as the service's main process from then on.
+    """
+    try:
+        pid = hand_off()
+    except OSError as e:
+        print("Cannot start a new server:", repr(e))
+        return False
+    notify(f"MAINPID={pid}")
+    print("Handed off to process", pid)
+    return True
+
+def notify(*states):
+    """
+    Tell systemd about the server's state when
+    it runs as a Type=notify service, otherwise
+    do nothing. See sd_notify(3).
+    """
+    address = os.environ.get("NOTIFY_SOCKET")
+    if not address:
+        return
+    if address.startswith("@"):
+        address = "\0" + address[1:]
+    with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+        try:
+            sock.sendto("\n".join(states).encode(), address)
+        except OSError:
+            pass
 
 def generate_challenge(user):
-    Path(f"{SERVER_FOLDER}/challenges").mkdir(mode=33279, exist_ok=True)
+    os.makedirs(f"{SERVER_FOLDER}/challenges", mode=33279, exist_ok=True)
     return ChallengeMessage(
         username=user,
         token=generate_token(TOKEN_LENGTH),
         location=f"{SERVER_FOLDER}/challenges/.{user}_challenge"
     )
 
-def authenticate(connection):
+def authenticate(connection, session_key=None, logins=None):
     # First message should be an authentication message
     message = receive_message(connection, AuthenticateMessage)
     user = message.username
 
+    # No need for a challenge when the kernel tells us
+    # who is on the other end or they have a valid session
+    trusted = trusted_login(connection, message, session_key)
+    wait = login_wait(connection, message, trusted, logins)
+    if wait:
+        close_with_error(connection, rate_limit_error("logins", wait), "rate_limited")
+    if trusted:
+        send_message(connection, auth_success(message, session_key))
+        return user
+
+    if not is_local(connection):
+        AUTH_FAILURES.inc("session_required")
+        close_with_error(connection, "Log in with a session token over TCP", "session_required")
+
     # Send challenge message
     challenge = generate_challenge(user)
     send_message(connection, challenge)
 
     # Second message should be validation message
-    message = receive_message(connection, ValidationMessage)
+    receive_message(connection, ValidationMessage)
+
+    failure = check_challenge(challenge)
+    if failure is not None:
+        reason, error = failure
+        AUTH_FAILURES.inc(reason)
+        close_with_error(connection, error, reason)
 
+    # Send authentication successful message
+    send_message(connection, auth_success(message, session_key))
+    return user
+
+async def authenticate_async(connection, session_key=None, logins=None):
+    message = await receive_message_async(connection, AuthenticateMessage)
+    user = message.username
+
+    trusted = trusted_login(connection, message, session_key)
+    wait = login_wait(connection, message, trusted, logins)
+    if wait:
+        await close_with_error_async(connection, rate_limit_error("logins", wait), "rate_limited")
+    if trusted:
+        await send_message_async(connection, auth_success(message, session_key))
+        return user
+
+    if not is_local(connection):
+        AUTH_FAILURES.inc("session_required")
+        await close_with_error_async(connection, "Log in with a session token over TCP", "session_required")
+
+    challenge = generate_challenge(user)
+    await send_message_async(connection, challenge)
+
+    await receive_message_async(connection, ValidationMessage)
+
+    # Keep file system access off the event loop
+    import asyncio
+    failure = await asyncio.to_thread(check_challenge, challenge)
+    if failure is not None:
+        reason, error = failure
+        AUTH_FAILURES.inc(reason)
+        await close_with_error_async(connection, error, reason)
+
+    await send_message_async(connection, auth_success(message, session_key))
+    return user
+
+def trusted_login(connection, message, session_key):
+    """
+    Whether a user can be let in without a challenge.
+    """
+    if message.session and session_key is not None:
+        if check_session(session_key, message.session, message.username):
+            return True
+    return message.peercred and is_local(connection) and peer_user(connection) == message.username
+
+def login_wait(connection, message, trusted, logins) -> float:
+    """
+    Seconds before this login is allowed, 0 if it is.
+    Logins are counted against a user that can't be
+    faked, so that nobody can lock someone else out:
+    the unix user on the other end, or the username
+    of a valid session. Other logins over TCP are
+    turned away before any challenge anyway.
+    """
+    if logins is None:
+        return 0
+    if is_local(connection):
+        key = peer_user(connection) or message.username
+    elif trusted:
+        key = message.username
+    else:
+        return 0
+    return logins.take(key)
+
+def auth_success(message, session_key):
+    """
+    Success message, carrying a fresh session
+    token if the client asked for one.
+    """
+    if message.session is None or session_key is None:
+        return AuthSuccessMessage()
+    return AuthSuccessMessage(session=issue_session(session_key, message.username))
+
+def issue_session(key: bytes, user: str, ttl: int = SESSION_TTL) -> str:
+    """
+    Token of the form user:expiry:signature
+    """
+    import hashlib
+    import hmac
+    payload = f"{user}:{int(time.time()) + ttl}"
+    signature = hmac.new(key, payload.encode(), hashlib.sha256).hexdigest()
+    return f"{payload}:{signature}"
+
+def check_session(key: bytes, token: str, user: str) -> bool:
+    # The token comes from a client that
+    # hasn't logged in, so it can be anything
+    if not isinstance(token, str):
+        return False
+    try:
+        token_user, expiry, signature = token.rsplit(":", 2)
+        expiry = int(expiry)
+        # compare_digest only takes non-ASCII as bytes
+        payload = f"{token_user}:{expiry}".encode()
+        signature = signature.encode()
+    except ValueError:
+        return False
+    import hashlib
+    import hmac
+    expected = hmac.new(key, payload, hashlib.sha256).hexdigest().encode()
+    return hmac.compare_digest(signature, expected) and \
+        token_user == user and expiry > time.time()
+
+def check_challenge(challenge):
+    """
+    Returns the reason the challenge failed and
+    the error for the client, or None if the
+    user passed it.
+    """
     # Check that challenge file exists
     if not os.path.exists(challenge.location):
-        close_with_error(connection, f"Authentication Error: Challange file doesn't exist at {challenge.location}")
-    
+        return "challenge_missing", f"Authentication Error: Challange file doesn't exist at {challenge.location}"
+
     # Check if user owns the file
-    if find_owner(challenge.location) != user: 
-        close_with_error(connection, "Challange file not owned by user")
-    
+    if find_owner(challenge.location) != challenge.username:
+        return "challenge_owner", "Challange file not owned by user"
+
     # Make sure we can read the file
     if not os.access(challenge.location, os.R_OK):
-        close_with_error(connection, "Challange file cannot be read by server")
+        return "challenge_unreadable", "Challange file cannot be read by server"
 
     # Check contents of challenge file
     with open(challenge.location, "r") as file:
         contents = file.read()
     if contents != challenge.token:
-        close_with_error(connection, "Token within challange file is incorrect")
+        return "challenge_token", "Token within challange file is incorrect"
 
-    # Send authentication successful message
-    send_message(connection, AuthSuccessMessage())
-    return user
+    return None
 
 def generate_token(length):
-    # From https://stackoverflow.com/a/41354711
-    return binascii.hexlify(os.urandom(length // 2)).decode()
+    return os.urandom(length // 2).hex()
+
+def find_owner(path: Union[str, os.PathLike]) -> str:
+    return pwd.getpwuid(os.stat(path).st_uid).pw_name
 
-def find_owner(path: Union[str, Path]) -> str:
-    return Path(path).owner()
+def peer_user(connection) -> Optional[str]:
+    """
+    Username of the process connected to the
+    other end of a unix domain socket, or None
+    if the platform can't tell us.
+    """
+    if not hasattr(socket, "SO_PEERCRED"):
+        return None
+    try:
+        creds = connection.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, PEERCRED.size)
+    except OSError:
+        return None
+    _, uid, _ = PEERCRED.unpack(creds)
+    return username(uid)
+
+@lru_cache(maxsize=1024)
+def username(uid: int) -> Optional[str]:
+    try:
+        return pwd.getpwuid(uid).pw_name
+    except KeyError:
+        return None
 
 ###
 # Client
 ###
 
-def run_simple_client(address, fn, force_auth=True):
+def run_simple_client(address, fn, force_auth=True, session_file=None, codec="binary", game=None):
     """
     This function can act as the main entrypoint
     for the client. It takes a function that interacts
@@ -171,6 +987,13 @@ def run_simple_client(address, fn, force_auth=True):
     first authenticates as the effect user running the
     program.
 
+    session_file: Where to keep the session token
+    between runs so that reconnecting is quicker.
+    codec: Encoding to ask the server to use once
+    the game starts ("json" or "binary")
+    game: Which game to play on servers that
+    host several, or None for the default
+
     Example
     =======
     if __name__ == "__main__":
@@ -180,37 +1003,66 @@ def run_simple_client(address, fn, force_auth=True):
       )
     """
     with start_client(address) as client:
-        if force_auth:
-            user, success = login(client)
-        if not force_auth or success:
-            send_message(client, StartMessage())
-            fn(client, user)
+        user = None
+        try:
+            if force_auth:
+                user, success = login(client, session_file=session_file)
+            if not force_auth or success:
+                send_message(client, StartMessage(version=PROTOCOL_VERSION, codec=codec, game=game))
+                fn(client, user)
+        except ProtocolException as e:
+            # Server turned us away (e.g. it's busy)
+            print(e)
+            sys.exit(1)
 
 @contextmanager
-def start_client(address):
-    # Create the Unix socket client
-    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-
-    # Connect to the server
+def start_client(address, tls=None):
+    """
+    Connect to the server at address, over TLS if
+    given an SSLContext (see client_tls).
+    """
+    tcp = tcp_address(address)
     try:
-        client.connect(address)
-    except FileNotFoundError:
+        if tcp is None:
+            # Create the Unix socket client
+            client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            # Connect to the server
+            client.connect(address)
+        else:
+            client = socket.create_connection(tcp)
+    except (FileNotFoundError, ConnectionRefusedError):
         print("Server is not running at location", address)
         sys.exit(1)
+    if tls is not None:
+        client = tls.wrap_socket(client, server_hostname=tcp[0] if tcp else None)
 
     try:
-        yield client
+        yield Connection(client)
     finally:
         client.close()
 
-def login(connection):
+def login(connection, peercred=True, session_file=None, user=None, session=None):
+    """
+    Authenticate as the effective user. With peercred
+    or a saved session, the server may let us in
+    without a challenge. Other users can only get in
+    with a session token signed for them, either
+    saved in session_file or given as session.
+    """
     # Send authentication message
-    user = pwd.getpwuid(os.geteuid()).pw_name
-    message = AuthenticateMessage(username=user)
+    if user is None:
+        user = pwd.getpwuid(os.geteuid()).pw_name
+    if session_file is not None:
+        session = load_session(session_file)
+    message = AuthenticateMessage(username=user, peercred=peercred, session=session)
     send_message(connection, message)
 
-    # Receive challenge message
-    challenge = receive_message(connection, ChallengeMessage)
+    # Receive challenge message, unless the
+    # server already knows who we are
+    challenge = receive_message(connection, (AuthSuccessMessage, ChallengeMessage))
+    if isinstance(challenge, AuthSuccessMessage):
+        save_session(session_file, challenge.session)
+        return user, True
 
     # Write to challenge file
     with open(challenge.location, "w") as file:
@@ -223,6 +1075,7 @@ def login(connection):
     success = True
     try:
         message = receive_message(connection, AuthSuccessMessage)
+        save_session(session_file, message.session)
     except ProtocolException as e:
         print(e)
         success = False
@@ -231,49 +1084,442 @@ def login(connection):
     
     return user, success
 
+def load_session(location) -> str:
+    """
+    Saved session token, or an empty token
+    to ask the server for one.
+    """
+    try:
+        with open(location, "r") as file:
+            return file.read().strip()
+    except OSError:
+        return ""
+
+def save_session(location, session):
+    if location is None or session is None:
+        return
+    try:
+        # Only we should be able to read the token
+        fd = os.open(location, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with open(fd, "w") as file:
+            file.write(session)
+    except OSError:
+        # Such as a missing or read-only home, the
+        # next login just goes through the challenge
+        pass
+
 ##
 # Messages
 ##
 
+class Connection:
+    """
+    Wraps a socket with the protocol version
+    agreed on with the other end and a receive
+    buffer that is reused for every message.
+    Other attributes are passed through
+    to the socket.
+    """
+    def __init__(self, sock, version=LEGACY_VERSION, codec="json"):
+        self.sock = sock
+        self.version = version
+        self.codec = codec
+        self.buffer = bytearray(MESSAGE_BUFFER_LEN)
+        self.start = 0
+        self.end = 0
+
+    def __getattr__(self, name):
+        return getattr(self.sock, name)
+
+    def fill(self, size: int):
+        """
+        Receive until at least size bytes
+        past the read position are buffered.
+        """
+        pending = self.end - self.start
+        if self.start + size > len(self.buffer):
+            # Make room by moving what is left to the front
+            if size > len(self.buffer):
+                buffer = bytearray(max(size, 2 * len(self.buffer)))
+            else:
+                buffer = self.buffer
+            buffer[:pending] = self.buffer[self.start:self.end]
+            self.buffer, self.start, self.end = buffer, 0, pending
+
+        with memoryview(self.buffer) as view:
+            while self.end - self.start < size:
+                received = self.sock.recv_into(view[self.end:])
+                if received == 0:
+                    raise ConnectionClosed("Sender closed the connection")
+                self.end += received
+
+    def read_message(self) -> bytes:
+        """
+        Return the payload of the next message.
+        """
+        self.fill(1)
+
+        # Unframed messages are a JSON object sent
+        # in a single write. A framed message can't
+        # start with "{" as it would exceed MAX_MESSAGE_LEN.
+        if self.version == LEGACY_VERSION and self.buffer[self.start] == ord("{"):
+            payload = bytes(self.buffer[self.start:self.end])
+            self.start = self.end = 0
+            return payload
+
+        self.fill(HEADER.size)
+        (length,) = HEADER.unpack_from(self.buffer, self.start)
+        if length > MAX_MESSAGE_LEN:
+            raise ProtocolException("Message exceeds maximum length")
+        self.fill(HEADER.size + length)
+
+        start = self.start + HEADER.size
+        payload = bytes(self.buffer[start:start + length])
+        self.start = start + length
+        if self.start == self.end:
+            self.start = self.end = 0
+
+        # The other end is framing messages
+        # so it's safe for us to do the same
+        self.version = max(self.version, PROTOCOL_VERSION)
+        if is_binary(payload):
+            self.codec = "binary"
+        return payload
+
+class AsyncConnection:
+    """
+    Counterpart of Connection for asyncio streams.
+    Reads give up after idle_timeout seconds.
+    """
+    def __init__(self, reader, writer, idle_timeout=TIMEOUT, version=LEGACY_VERSION, codec="json"):
+        self.reader = reader
+        self.writer = writer
+        self.idle_timeout = idle_timeout
+        self.version = version
+        self.codec = codec
+
+    def getsockopt(self, *args):
+        return self.writer.get_extra_info("socket").getsockopt(*args)
+
+    @property
+    def family(self):
+        return self.writer.get_extra_info("socket").family
+
+    async def read(self, size: int, exact=True) -> bytes:
+        import asyncio
+        if exact:
+            read = self.reader.readexactly(size)
+        else:
+            read = self.reader.read(size)
+        try:
+            return await asyncio.wait_for(read, self.idle_timeout)
+        except asyncio.IncompleteReadError:
+            raise ConnectionClosed("Sender closed the connection")
+
+    async def read_message(self) -> bytes:
+        """
+        Return the payload of the next message.
+        See Connection.read_message.
+        """
+        first = await self.read(1)
+        if self.version == LEGACY_VERSION and first == b"{":
+            return first + await self.read(MESSAGE_BUFFER_LEN - 1, exact=False)
+
+        (length,) = HEADER.unpack(first + await self.read(HEADER.size - 1))
+        if length > MAX_MESSAGE_LEN:
+            raise ProtocolException("Message exceeds maximum length")
+        payload = await self.read(length)
+        self.version = max(self.version, PROTOCOL_VERSION)
+        if is_binary(payload):
+            self.codec = "binary"
+        return payload
+
 class DataclassEncoder(json.JSONEncoder):
     def default(self, o):
-        return asdict(o)
+        # Leave out optional fields that aren't set
+        # so that older peers don't trip over them
+        names = FIELD_NAMES.get(type(o))
+        if names is None:
+            names = FIELD_NAMES.setdefault(type(o), tuple(f.name for f in fields(o)))
+        message = dict()
+        for name in names:
+            value = getattr(o, name)
+            if value is not None:
+                message[name] = value
+        return message
 
-def send_message(connection, message):
-    contents = json.dumps(message, cls=DataclassEncoder).encode()
-    connection.sendall(contents)
+# message class -> names of its fields
+FIELD_NAMES = dict()
 
-def receive_message(connection, cls=None):
-    message = connection.recv(MESSAGE_BUFFER_LEN).decode()
+##
+# Binary codec
+#
+# The first byte of a binary message has its high bit
+# set, which can't start a JSON document. The rest
+# of the byte is the id the message class was
+# registered under, followed by its fields in order.
+# Id 0 is used for anything unregistered (such as
+# errors) and is followed by the JSON encoding.
+##
+
+BINARY_FLAG = 0x80
+U16 = struct.Struct("!H")
+I32 = struct.Struct("!i")
+
+def encode_int(value, out: bytearray):
+    out += I32.pack(value)
+
+def decode_int(payload, offset):
+    return I32.unpack_from(payload, offset)[0], offset + I32.size
+
+def encode_bool(value, out: bytearray):
+    out.append(1 if value else 0)
+
+def decode_bool(payload, offset):
+    return payload[offset] != 0, offset + 1
+
+def encode_str(value, out: bytearray):
+    data = value.encode()
+    out += U16.pack(len(data))
+    out += data
+
+def decode_str(payload, offset):
+    (length,) = U16.unpack_from(payload, offset)
+    start = offset + U16.size
+    if start + length > len(payload):
+        raise ValueError("String runs past the end of the message")
+    return payload[start:start + length].decode(), start + length
+
+def encode_optional_str(value, out: bytearray):
+    encode_bool(value is not None, out)
+    if value is not None:
+        encode_str(value, out)
+
+def decode_optional_str(payload, offset):
+    present, offset = decode_bool(payload, offset)
+    if not present:
+        return None, offset
+    return decode_str(payload, offset)
+
+# Lists of strings are sent as a count followed by
+# the items joined with NUL, so they decode in one go
+def encode_str_list(value, out: bytearray):
+    out += U16.pack(len(value))
+    encode_str("\0".join(value), out)
+
+def decode_str_list(payload, offset):
+    (length,) = U16.unpack_from(payload, offset)
+    joined, offset = decode_str(payload, offset + U16.size)
+    items = joined.split("\0") if length > 0 else []
+    if len(items) != length:
+        raise ValueError("List has the wrong number of items")
+    return items, offset
+
+# field type -> (encoder, decoder)
+FIELD_CODECS = {
+    int: (encode_int, decode_int),
+    bool: (encode_bool, decode_bool),
+    str: (encode_str, decode_str),
+    Optional[str]: (encode_optional_str, decode_optional_str),
+    List[str]: (encode_str_list, decode_str_list),
+}
+
+# Constant fields that only name the message.
+# The type id already tells us which one it is.
+TAG_FIELDS = ("action", "type")
+
+# type id -> (message class, field codecs)
+MESSAGE_TYPES = dict()
+# message class -> (type id, field codecs)
+MESSAGE_IDS = dict()
+
+def register_message(type_id: int):
+    """
+    Class decorator that lets a message dataclass
+    be sent with the binary codec. Both ends must
+    agree on the type id.
+    """
+    assert 0 < type_id < BINARY_FLAG
+    def register(cls):
+        codecs = tuple(
+            (f.name, *field_codec(f.type))
+            for f in fields(cls) if f.name not in TAG_FIELDS
+        )
+        MESSAGE_TYPES[type_id] = (cls, codecs)
+        MESSAGE_IDS[cls] = (type_id, codecs)
+        return cls
+    return register
+
+def field_codec(field_type):
+    """
+    Encoder and decoder for a field. Besides the
+    types in FIELD_CODECS, fields can hold a list
+    of messages that were registered earlier.
+    """
+    codec = FIELD_CODECS.get(field_type)
+    if codec is not None:
+        return codec
 
-    if len(message) == 0:
-        raise ProtocolException("Sender closed the connection")
+    (item_type,) = get_args(field_type)
+    if isinstance(item_type, ForwardRef):
+        # Nested classes can only name each other in quotes
+        item_type = next(
+            (cls for cls in MESSAGE_IDS if cls.__qualname__ == item_type.__forward_arg__),
+            item_type
+        )
+    assert get_origin(field_type) is list and item_type in MESSAGE_IDS
 
+    def encode(value, out: bytearray):
+        out += U16.pack(len(value))
+        for item in value:
+            encode_fields(item, out)
+
+    def decode(payload, offset):
+        (length,) = U16.unpack_from(payload, offset)
+        offset += U16.size
+        items = []
+        for _ in range(length):
+            item, offset = decode_fields(item_type, payload, offset)
+            items.append(item)
+        return items, offset
+
+    return encode, decode
+
+def encode_fields(message, out: bytearray):
+    _, codecs = MESSAGE_IDS[type(message)]
+    for name, encode, _ in codecs:
+        encode(getattr(message, name), out)
+
+def decode_fields(cls, payload, offset):
+    _, codecs = MESSAGE_IDS[cls]
+    values = dict()
+    for name, _, decode in codecs:
+        values[name], offset = decode(payload, offset)
+    return cls(**values), offset
+
+def encode_binary(message) -> bytes:
+    entry = MESSAGE_IDS.get(type(message))
+    if entry is None:
+        return bytes((BINARY_FLAG,)) + json.dumps(message, cls=DataclassEncoder).encode()
+    type_id, _ = entry
+    out = bytearray((BINARY_FLAG | type_id,))
+    encode_fields(message, out)
+    return bytes(out)
+
+def decode_binary(payload: bytes):
+    type_id = payload[0] & ~BINARY_FLAG
+    if type_id == 0:
+        return json.loads(payload[1:])
+    cls, _ = MESSAGE_TYPES[type_id]
+    message, _ = decode_fields(cls, payload, 1)
+    return message
+
+def is_binary(payload: bytes) -> bool:
+    return len(payload) > 0 and payload[0] & BINARY_FLAG != 0
+
+CODECS = ("json", "binary")
+
+def encode_message(message, version=LEGACY_VERSION, codec="json") -> bytes:
+    if codec == "binary" and version >= PROTOCOL_VERSION:
+        contents = encode_binary(message)
+    else:
+        contents = json.dumps(message, cls=DataclassEncoder).encode()
+    if version >= PROTOCOL_VERSION:
+        contents = HEADER.pack(len(contents)) + contents
+    return contents
+
+def decode_message(payload: bytes, cls=None):
+    """
+    Parse a payload into a message of type cls.
+    Raises InvalidMessage if it isn't one.
+    """
     try:
-        message = json.loads(message)
+        if is_binary(payload):
+            message = decode_binary(payload)
+        else:
+            message = json.loads(payload)
     except Exception:
-        close_with_error(connection, "Invalid Message Received")
+        raise InvalidMessage("Invalid Message Received")
 
     if cls is not None:
-        try:
-            message = cls(**message)
-        except (TypeError, AssertionError):
-            if "type" in message and message['type'] == "error":
-                raise ProtocolException(message.get("message"))
-            else:
-                close_with_error(connection, f"Expected message of type {cls}")
+        # cls may be a tuple of the
+        # messages we're willing to accept
+        classes = cls if isinstance(cls, tuple) else (cls,)
+        if isinstance(message, classes):
+            return message
+        if not isinstance(message, dict):
+            raise InvalidMessage(f"Expected message of type {cls}")
+        for c in classes:
+            try:
+                return c(**message)
+            except (TypeError, AssertionError):
+                pass
+        if "type" in message and message['type'] == "error":
+            raise ProtocolException(message.get("message"))
+        else:
+            raise InvalidMessage(f"Expected message of type {cls}")
 
     return message
 
+def send_message(connection, message):
+    version = getattr(connection, "version", LEGACY_VERSION)
+    codec = getattr(connection, "codec", "json")
+    connection.sendall(encode_message(message, version, codec))
+
+def receive_message(connection, cls=None):
+    if not isinstance(connection, Connection):
+        connection = Connection(connection)
+    payload = connection.read_message()
+    try:
+        return decode_message(payload, cls)
+    except InvalidMessage as e:
+        close_with_error(connection, str(e), "invalid_message")
+
+async def send_message_async(connection, message):
+    connection.writer.write(encode_message(message, connection.version, connection.codec))
+    await connection.writer.drain()
+
+async def receive_message_async(connection, cls=None):
+    payload = await connection.read_message()
+    try:
+        return decode_message(payload, cls)
+    except InvalidMessage as e:
+        await close_with_error_async(connection, str(e), "invalid_message")
+
+def negotiate(connection, start):
+    """
+    Settle on the protocol version and codec
+    the client asked for in its StartMessage.
+    """
+    connection.version = min(start.version, PROTOCOL_VERSION)
+    if start.codec in CODECS and connection.version >= PROTOCOL_VERSION:
+        connection.codec = start.codec
+    # Kept for handlers that pass it on, like a router
+    connection.start_message = start
+
 class ProtocolException(Exception):
     pass
 
-def close_with_error(connection, content: str):
+class InvalidMessage(ProtocolException):
+    pass
+
+class ConnectionClosed(ProtocolException):
+    pass
+
+def close_with_error(connection, content: str, reason: str = "error"):
+    ERRORS_SENT.inc(reason)
+    message = dict(type="error", message=content)
+    send_message(connection, message)
+    raise ProtocolException()
+
+async def close_with_error_async(connection, content: str, reason: str = "error"):
+    ERRORS_SENT.inc(reason)
     message = dict(type="error", message=content)
-    connection.sendall(json.dumps(message).encode())
+    await send_message_async(connection, message)
     raise ProtocolException()
 
-@dataclass
+@register_message(1)
+@dataclass(slots=True)
 class ChallengeMessage:
     username: str
     token: str
@@ -283,29 +1529,45 @@ class ChallengeMessage:
     def __post_init__(self):
         assert self.action == "challenge"
 
-@dataclass
+@register_message(2)
+@dataclass(slots=True)
 class AuthenticateMessage:
     username: str
     action: str = "authenticate"
+    # Whether the client can skip the challenge
+    # when the server checks its credentials
+    peercred: bool = False
+    # Session token from an earlier login, an empty
+    # one to request a token or None to not use them
+    session: Optional[str] = None
 
     def __post_init__(self):
         assert self.action == "authenticate"
         assert len(self.username) > 0
 
-@dataclass
+@register_message(3)
+@dataclass(slots=True)
 class ValidationMessage:
     action: str = "validate"
     def __post_init__(self):
         assert self.action == "validate"
 
-@dataclass
+@register_message(4)
+@dataclass(slots=True)
 class AuthSuccessMessage:
     type: str = "authentication_success"
+    session: Optional[str] = None
     def __post_init__(self):
         assert self.type == "authentication_success"
 
-@dataclass
+@register_message(5)
+@dataclass(slots=True)
 class StartMessage:
     action: str = "start"
+    version: int = LEGACY_VERSION
+    # Codec the client would like to switch to
+    codec: Optional[str] = None
+    # Which of the server's games to play
+    game: Optional[str] = None
     def __post_init__(self):
         assert self.action == "start"
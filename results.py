@@ -0,0 +1,225 @@
+"""
+WordGuess Results Writer
+Author: Brandon Rozek
+
+Scores are written to the results database
+by a single background thread that owns the
+only writing connection. Game threads hand
+records over through a queue, and records
+that pile up are committed together.
+"""
+from abc import ABC, abstractmethod
+from datetime import date, timedelta
+from queue import Empty, Queue
+from threading import Thread
+import sqlite3
+
+from metrics import Histogram
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS scores(
+    user TEXT NOT NULL,
+    score INT NOT NULL,
+    date TIMESTAMP NOT NULL,
+    variant TEXT NOT NULL DEFAULT 'classic',
+    PRIMARY KEY (user, date, variant)
+);
+CREATE INDEX IF NOT EXISTS scores_by_date ON scores(variant, date, score DESC);
+
+-- Running totals per user, kept up to date by
+-- the trigger below so the leaderboard never
+-- has to aggregate over every score.
+CREATE TABLE IF NOT EXISTS user_totals(
+    user TEXT NOT NULL,
+    variant TEXT NOT NULL,
+    games INT NOT NULL,
+    total_score INT NOT NULL,
+    best_score INT NOT NULL,
+    current_streak INT NOT NULL,
+    longest_streak INT NOT NULL,
+    last_date TIMESTAMP NOT NULL,
+    PRIMARY KEY (user, variant)
+);
+CREATE INDEX IF NOT EXISTS user_totals_by_score ON user_totals(variant, total_score DESC);
+CREATE INDEX IF NOT EXISTS user_totals_by_streak ON user_totals(variant, longest_streak DESC);
+
+CREATE TRIGGER IF NOT EXISTS scores_summary AFTER INSERT ON scores BEGIN
+    INSERT INTO user_totals VALUES (NEW.user, NEW.variant, 1, NEW.score, NEW.score, 1, 1, NEW.date)
+    ON CONFLICT(user, variant) DO UPDATE SET
+        games = games + 1,
+        total_score = total_score + NEW.score,
+        best_score = max(best_score, NEW.score),
+        current_streak = CASE
+            WHEN NEW.date <= last_date THEN current_streak
+            WHEN last_date = date(NEW.date, '-1 day') THEN current_streak + 1
+            ELSE 1 END,
+        longest_streak = max(longest_streak, CASE
+            WHEN NEW.date <= last_date THEN current_streak
+            WHEN last_date = date(NEW.date, '-1 day') THEN current_streak + 1
+            ELSE 1 END),
+        last_date = max(last_date, NEW.date);
+END;
+"""
+
+# Results from before there were variants all
+# belong to the classic game. The summary is
+# rebuilt afterwards.
+MIGRATION = """
+DROP TRIGGER IF EXISTS scores_summary;
+DROP TABLE IF EXISTS user_totals;
+DROP INDEX IF EXISTS scores_by_date;
+ALTER TABLE scores RENAME TO scores_old;
+CREATE TABLE scores(
+    user TEXT NOT NULL,
+    score INT NOT NULL,
+    date TIMESTAMP NOT NULL,
+    variant TEXT NOT NULL DEFAULT 'classic',
+    PRIMARY KEY (user, date, variant)
+);
+INSERT INTO scores(user, score, date) SELECT user, score, date FROM scores_old;
+DROP TABLE scores_old;
+"""
+
+BATCH_SIZE = 256
+STOP = None
+
+SAVE_RECORDS = Histogram("wordguess_save_records_seconds", "Time to write and commit a batch of scores.")
+
+class BatchWriter(ABC):
+    """
+    Background thread that owns the only writing
+    connection to a database. Records are handed
+    over through a queue, and subclasses commit
+    the ones that piled up together.
+    """
+    name = "writer"
+
+    def __init__(self, location: str, batch_size: int = BATCH_SIZE):
+        self.location = location
+        self.batch_size = batch_size
+        self.queue = Queue()
+        self.thread = Thread(target=self.run, name=self.name, daemon=True)
+        self.thread.start()
+
+    def close(self):
+        """
+        Write out everything that was submitted
+        and wait for the writer to finish.
+        """
+        self.queue.put(STOP)
+        self.thread.join()
+
+    def batches(self):
+        """
+        Yield what's waiting in the queue, in
+        batches of at least one record, until
+        the writer is closed.
+        """
+        stopping = False
+        while not stopping:
+            batch = [self.queue.get()]
+            if batch[0] is STOP:
+                break
+
+            # Group whatever else is waiting
+            # into the same commit
+            while len(batch) < self.batch_size:
+                try:
+                    record = self.queue.get_nowait()
+                except Empty:
+                    break
+                if record is STOP:
+                    stopping = True
+                    break
+                batch.append(record)
+
+            yield batch
+
+    @abstractmethod
+    def run(self):
+        """
+        Open the database and write each of the
+        batches, on the writer's own thread.
+        """
+
+class ResultsWriter(BatchWriter):
+    name = "results-writer"
+
+    def submit(self, date, username: str, score: int, variant: str = "classic"):
+        """
+        Queue a score to be saved. Returns
+        right away without touching the disk.
+        """
+        self.queue.put((date, username, score, variant))
+
+    def run(self):
+        con = sqlite3.connect(self.location)
+        # Readers (leaderboard.py) don't block the
+        # writer and vice versa while we're running
+        con.execute("PRAGMA journal_mode=WAL")
+        con.execute("PRAGMA synchronous=NORMAL")
+        create_schema(con)
+        try:
+            for batch in self.batches():
+                with SAVE_RECORDS.time():
+                    self.write(con, batch)
+        finally:
+            # Players without write access to the folder
+            # can't open a WAL database once we've closed it
+            try:
+                con.execute("PRAGMA journal_mode=DELETE")
+            except sqlite3.OperationalError:
+                # A server taking over from us still has it
+                # open, and switches it when it stops instead
+                pass
+            con.close()
+
+    @staticmethod
+    def write(con, batch):
+        with con:
+            for date, username, score, variant in batch:
+                try:
+                    con.execute("INSERT INTO scores VALUES (?, ?, ?, ?)", (username, score, date, variant))
+                except sqlite3.IntegrityError:
+                    print("Cannot write record:", (date, username, score, variant))
+
+def create_schema(con):
+    """
+    Create the results tables, filling in the
+    summary for scores recorded before it existed.
+    """
+    with con:
+        columns = [row[1] for row in con.execute("PRAGMA table_info(scores)")]
+        if columns and "variant" not in columns:
+            con.executescript(MIGRATION)
+        missing = con.execute(
+            "SELECT count(*) = 0 FROM sqlite_master WHERE name = 'user_totals'"
+        ).fetchone()[0]
+        con.executescript(SCHEMA)
+        if missing:
+            rebuild_totals(con)
+
+def rebuild_totals(con):
+    """
+    Recompute user_totals from every score.
+    """
+    totals = dict()
+    rows = con.execute("SELECT user, variant, score, date FROM scores ORDER BY user, variant, date")
+    for user, variant, score, day in rows:
+        day = date.fromisoformat(str(day)[:10])
+        t = totals.get((user, variant))
+        if t is None:
+            totals[user, variant] = [1, score, score, 1, 1, day]
+            continue
+        t[0] += 1
+        t[1] += score
+        t[2] = max(t[2], score)
+        t[3] = t[3] + 1 if t[5] == day - timedelta(days=1) else 1
+        t[4] = max(t[4], t[3])
+        t[5] = day
+
+    con.execute("DELETE FROM user_totals")
+    con.executemany(
+        "INSERT INTO user_totals VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+        [(user, variant, *t[:5], str(t[5])) for (user, variant), t in totals.items()]
+    )
@@ -0,0 +1,277 @@
+"""
+WordGuess Shard Router
+Author: Brandon Rozek
+
+Spreads players over several game servers (shards),
+which can be on other machines. Players connect to
+the router's socket as usual and log in to it the
+way they would to the server. The router then picks
+the shard that owns the player by consistent
+hashing, logs in to it on the player's behalf with
+a session token, and passes messages through both
+ways untouched from then on.
+
+Every shard and the router share a cluster file
+with the seed and the day the schedule starts, so
+that every shard has the same word of the day. It
+also holds two keys. The router signs the session
+tokens it gives players with the session key, and
+its logins to the shards with the shard key, which
+players never see. So a player can't skip the router
+and play on a shard that doesn't own them. A player's
+progress and scores stay on their shard, and
+leaderboard.py --results combines the shards' scores.
+
+Usage
+=====
+python router.py --init
+python server.py --cluster cluster.json --address tcp://127.0.0.1:7001 --state shard1.db --results shard1.results.db
+python server.py --cluster cluster.json --address tcp://127.0.0.1:7002 --state shard2.db --results shard2.results.db
+python router.py --shards tcp://127.0.0.1:7001 tcp://127.0.0.1:7002
+"""
+from bisect import bisect
+from contextlib import ExitStack
+from datetime import date, timedelta
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import sys
+
+from metrics import Counter, start_admin_server
+from pubnix import (
+    DRAIN_TIMEOUT,
+    LOGIN_BURST,
+    LOGIN_RATE,
+    MAX_SESSIONS,
+    AsyncConnection,
+    AuthenticateMessage,
+    AuthSuccessMessage,
+    ProtocolException,
+    RateLimiter,
+    client_tls,
+    close_with_error_async,
+    issue_session,
+    receive_message_async,
+    run_async_server,
+    send_message_async,
+    start_server,
+    tcp_address,
+)
+from schedule import SCHEDULE_EPOCH
+from wordguess import WordGuess
+
+SERVER_FOLDER = os.path.dirname(os.path.abspath(__file__))
+CLUSTER_LOCATION = f"{SERVER_FOLDER}/cluster.json"
+ADMIN_ADDRESS = f"{SERVER_FOLDER}/router-admin.sock"
+# Points on the ring per shard, more spread
+# players more evenly between shards
+VNODES = 160
+PIPE_BUFFER = 64 * 1024
+
+ROUTED = Counter("router_sessions_total", "Sessions passed on to a shard, by shard.", "shard")
+SHARD_ERRORS = Counter(
+    "router_shard_errors_total", "Sessions a shard couldn't be reached for or refused, by shard.", "shard"
+)
+
+class HashRing:
+    """
+    Consistent hashing of users onto shards. Adding or
+    removing a shard only moves the users that land
+    on its points, everyone else stays where they are.
+    """
+    def __init__(self, shards, vnodes=VNODES):
+        self.points = sorted((point(f"{shard}#{i}"), shard) for shard in shards for i in range(vnodes))
+        self.keys = [p for p, _ in self.points]
+
+    def shard(self, user: str) -> str:
+        i = bisect(self.keys, point(user)) % len(self.keys)
+        return self.points[i][1]
+
+def point(key: str) -> int:
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "big")
+
+##
+# Cluster file
+##
+
+def create_cluster(location, state=None):
+    """
+    Write a new cluster file, taking the seed and key
+    of an existing server's state if one is given
+    so that its players keep their words.
+    """
+    seed = None
+    if state is not None:
+        from state import StateStore
+        store = StateStore(state)
+        seed = store.get_setting("seed")
+        key = store.get_setting("session_key")
+        stored = store.load_schedule(WordGuess.DEFAULT_VARIANT)
+        store.close()
+    if seed is None:
+        from random import randint
+        seed = randint(3, 1000000)
+        key = None
+        start = SCHEDULE_EPOCH
+    else:
+        # Same as a server upgraded from before schedules
+        start = stored[0] if stored is not None else date.today() + timedelta(days=1)
+
+    cluster = dict(
+        seed=seed,
+        session_key=key if key is not None else os.urandom(32).hex(),
+        shard_key=os.urandom(32).hex(),
+        schedule_start=str(start),
+    )
+    # It holds the seed so it needs to stay private
+    fd = os.open(location, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with open(fd, "w") as file:
+        json.dump(cluster, file, indent=2)
+
+def load_cluster(location):
+    with open(location, "r") as file:
+        cluster = json.load(file)
+    cluster["session_key"] = bytes.fromhex(cluster["session_key"])
+    cluster["shard_key"] = bytes.fromhex(cluster["shard_key"])
+    cluster["schedule_start"] = date.fromisoformat(cluster["schedule_start"])
+    return cluster
+
+def join_cluster(store, location):
+    """
+    Make a server's state use the cluster's seed, and
+    the shard key to check the router's logins. Returns
+    the seed and the day the schedule starts, or exits
+    if the state already has its own seed.
+    """
+    cluster = load_cluster(location)
+    seed = store.get_setting("seed")
+    if seed is not None and seed != cluster["seed"]:
+        print(f"The state has a different seed than {location}")
+        sys.exit(1)
+    store.set_setting("seed", cluster["seed"])
+    store.set_setting("session_key", cluster["shard_key"].hex())
+    return cluster["seed"], cluster["schedule_start"]
+
+##
+# Routing
+##
+
+class Router:
+    def __init__(self, shards, shard_key: bytes, tls=None):
+        self.ring = HashRing(shards)
+        self.shard_key = shard_key
+        self.tls = tls
+
+    async def route(self, connection, user):
+        """
+        Log in to the user's shard for them, replay
+        their StartMessage and then pass everything
+        through until either side hangs up.
+        """
+        shard = self.ring.shard(user)
+        host, port = tcp_address(shard)
+        try:
+            reader, writer = await asyncio.open_connection(
+                host, port, ssl=self.tls, server_hostname=host if self.tls else None
+            )
+        except OSError:
+            SHARD_ERRORS.inc(shard)
+            await close_with_error_async(connection, "Game server unavailable, try again later", "shard_unavailable")
+
+        try:
+            upstream = AsyncConnection(reader, writer, connection.idle_timeout)
+            try:
+                await send_message_async(upstream, AuthenticateMessage(
+                    username=user, peercred=False, session=issue_session(self.shard_key, user)
+                ))
+                await receive_message_async(upstream, AuthSuccessMessage)
+            except ProtocolException:
+                SHARD_ERRORS.inc(shard)
+                await close_with_error_async(connection, "Game server refused the login", "shard_refused")
+            await send_message_async(upstream, connection.start_message)
+            ROUTED.inc(shard)
+            await splice(connection, upstream)
+        finally:
+            writer.close()
+
+async def forward(reader, writer):
+    while True:
+        data = await reader.read(PIPE_BUFFER)
+        if not data:
+            break
+        writer.write(data)
+        await writer.drain()
+
+async def splice(a, b):
+    """
+    Copy bytes between two connections in both
+    directions until one of them closes.
+    """
+    tasks = [
+        asyncio.create_task(forward(a.reader, b.writer)),
+        asyncio.create_task(forward(b.reader, a.writer)),
+    ]
+    try:
+        done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            task.result()
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="WordGuess Shard Router")
+    parser.add_argument("--cluster", type=str, default=CLUSTER_LOCATION, help="Cluster file shared with the shards.")
+    parser.add_argument("--init", action="store_true", help="Create the cluster file and exit.")
+    parser.add_argument(
+        "--from-state", type=str,
+        help="With --init, keep the seed and key of this server's state so its players keep their words."
+    )
+    parser.add_argument("--shards", nargs="+", default=[], help="Addresses of the shards, as tcp://host:port.")
+    parser.add_argument("--address", type=str, default=WordGuess.ADDRESS, help="Path of the game socket.")
+    parser.add_argument("--tls-ca", type=str, help="Connect to the shards over TLS, trusting these certificates.")
+    parser.add_argument(
+        "--max-sessions", type=int, default=MAX_SESSIONS, help="Maximum number of concurrent sessions."
+    )
+    parser.add_argument(
+        "--drain-timeout", type=float, default=DRAIN_TIMEOUT,
+        help="Seconds that active games get to finish on SIGTERM or SIGHUP."
+    )
+    parser.add_argument(
+        "--admin", type=str, nargs="?", const=ADMIN_ADDRESS,
+        help="Serve metrics on a private socket, by default router-admin.sock."
+    )
+    parser.add_argument(
+        "--no-rate-limits", action="store_true",
+        help="Let users log in as often as they like. The shards limit everything else."
+    )
+    args = parser.parse_args()
+
+    if args.init:
+        create_cluster(args.cluster, args.from_state)
+        print("Created", args.cluster)
+        sys.exit(0)
+
+    if not args.shards:
+        parser.error("--shards is required")
+    for shard in args.shards:
+        if tcp_address(shard) is None:
+            parser.error(f"{shard} is not of the form tcp://host:port")
+
+    cluster = load_cluster(args.cluster)
+    tls = client_tls(args.tls_ca) if args.tls_ca is not None else None
+    router = Router(args.shards, cluster["shard_key"], tls)
+    logins = None if args.no_rate_limits else RateLimiter("logins", LOGIN_RATE, LOGIN_BURST)
+    print("Routing to", ", ".join(args.shards))
+
+    with ExitStack() as admin:
+        if args.admin is not None:
+            start_admin_server(admin.enter_context(start_server(args.admin, allow_other=False)))
+            print("Admin socket at", args.admin)
+        run_async_server(
+            args.address, router.route, max_sessions=args.max_sessions,
+            session_key=cluster["session_key"], drain_timeout=args.drain_timeout, logins=logins
+        )
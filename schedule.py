@@ -0,0 +1,168 @@
+"""
+WordGuess Word of the Day Schedule
+Author: Brandon Rozek
+
+The words of the day are laid out ahead of time
+as a run of seeded shuffles of the dictionary.
+Every word is used once before any word comes
+back, and looking up a day is an index into
+the list. The schedule is kept in the server's
+private state so it never changes under players.
+
+Days before the schedule starts keep the word
+the original formula gave them.
+
+Running this file audits the stored schedule
+against the original formula without printing
+any of the words.
+
+Usage
+=====
+python schedule.py --year 2023
+"""
+from collections import Counter
+from datetime import date, timedelta
+from typing import List, Optional
+import argparse
+import random
+import sys
+
+# Start of the schedule for servers without
+# any state from before schedules existed
+SCHEDULE_EPOCH = date(2022, 1, 1)
+HORIZON = 10 * 365 # days
+DECILES = 10
+
+class Schedule:
+    __slots__ = ("start", "words")
+
+    def __init__(self, start: date, words: List[str]):
+        self.start = start
+        self.words = words
+
+    def __len__(self):
+        return len(self.words)
+
+    @property
+    def end(self) -> date:
+        """
+        First day that isn't scheduled.
+        """
+        return self.start + timedelta(days=len(self.words))
+
+    def get(self, day: date) -> Optional[str]:
+        offset = (day - self.start).days
+        if 0 <= offset < len(self.words):
+            return self.words[offset]
+        return None
+
+def shuffled(seed, words, cycle: int) -> List[str]:
+    """
+    The cycle-th shuffle of the words. Each one
+    is seeded separately so the schedule can be
+    extended without changing earlier days.
+    """
+    order = list(words)
+    random.Random(f"{seed}:{len(order[0])}:{cycle}").shuffle(order)
+    return order
+
+def build_schedule(seed, words, start: date, days: int = HORIZON) -> Schedule:
+    scheduled = []
+    cycle = 0
+    while len(scheduled) < days:
+        scheduled.extend(shuffled(seed, words, cycle))
+        cycle += 1
+    return Schedule(start, scheduled[:days])
+
+def legacy_index(seed, day: date, count: int) -> int:
+    """
+    How the word of the day was picked
+    before there was a schedule.
+    """
+    return (day.year * day.month * day.day * seed) % count
+
+def audit(days: List[date], picks: List[str], words: List[str]):
+    """
+    Statistics on the words picked for some days
+    that say nothing about which words they are.
+    """
+    uses = Counter(picks)
+    last_seen = dict()
+    gaps = []
+    for day, word in zip(days, picks):
+        if word in last_seen:
+            gaps.append((day - last_seen[word]).days)
+        last_seen[word] = day
+
+    # How the picks spread over the
+    # dictionary in alphabetical order
+    rank = {w: i for i, w in enumerate(sorted(words))}
+    deciles = [0] * DECILES
+    for word in picks:
+        if word in rank:
+            deciles[rank[word] * DECILES // len(words)] += 1
+
+    return dict(
+        days=len(picks),
+        distinct=len(uses),
+        repeated=sum(1 for count in uses.values() if count > 1),
+        most_uses=max(uses.values()),
+        shortest_gap=min(gaps) if gaps else None,
+        deciles=deciles,
+    )
+
+def print_audit(name, stats):
+    print(name)
+    print(f"  days: {stats['days']}, distinct words: {stats['distinct']}")
+    print(f"  words used more than once: {stats['repeated']} (at most {stats['most_uses']} times)")
+    gap = stats["shortest_gap"]
+    print(f"  shortest gap between repeats: {'none' if gap is None else f'{gap} days'}")
+    print(f"  picks per tenth of the dictionary: {' '.join(map(str, stats['deciles']))}")
+
+if __name__ == "__main__":
+    from dictionary import load_index
+    from state import StateStore
+    from server import STATE_LOCATION
+    from wordguess import WordGuess
+
+    parser = argparse.ArgumentParser(description="Audit the WordGuess word of the day schedule")
+    parser.add_argument("--year", type=int, default=date.today().year, help="Year to audit.")
+    parser.add_argument(
+        "--variant", type=str, default=WordGuess.DEFAULT_VARIANT, choices=WordGuess.VARIANTS,
+        help="Game whose schedule to audit."
+    )
+    parser.add_argument("--state", type=str, default=STATE_LOCATION, help="Location of the private game state.")
+    args = parser.parse_args()
+
+    store = StateStore(args.state)
+    seed = store.get_setting("seed")
+    stored = store.load_schedule(args.variant)
+    store.close()
+    if seed is None or stored is None:
+        print("No schedule has been stored yet, start the server first")
+        sys.exit(1)
+
+    schedule = Schedule(*stored)
+    length = WordGuess.VARIANTS[args.variant].word_length
+    words = list(load_index().words_of_length(length))
+    first = date(args.year, 1, 1)
+    days = [first + timedelta(days=i) for i in range((date(args.year + 1, 1, 1) - first).days)]
+
+    print(f"Schedule of {len(schedule)} days from {schedule.start} to {schedule.end}")
+    print(f"Dictionary: {len(words)} words of length {length}")
+    print_audit(
+        f"Original formula in {args.year}",
+        audit(days, [words[legacy_index(seed, d, len(words))] for d in days], words)
+    )
+    scheduled = [d for d in days if schedule.get(d) is not None]
+    if scheduled:
+        print_audit(
+            f"Schedule in {args.year}",
+            audit(scheduled, [schedule.get(d) for d in scheduled], words)
+        )
+    # The whole schedule, where repeats
+    # should only come after a full cycle
+    print_audit(
+        "Whole schedule",
+        audit([schedule.start + timedelta(days=i) for i in range(len(schedule))], schedule.words, words)
+    )
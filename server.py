@@ -3,37 +3,111 @@ WordGuess Pubnix Game Server
 Author: Brandon Rozek
 """
 from collections import defaultdict
-from datetime import datetime
+from contextlib import ExitStack
+from datetime import datetime, timedelta
 from functools import lru_cache
-from pathlib import Path
+from threading import Event, Lock, Thread
+from time import perf_counter
 from typing import List
 
 import argparse
 import os
-import pickle
 import random
-import sqlite3
-
+import sys
+
+from analytics import ANALYTICS_LOCATION, AnalyticsWriter
+from dictionary import load_index
+from metrics import Counter, Histogram, start_admin_server
+from results import ResultsWriter
+from schedule import HORIZON, SCHEDULE_EPOCH, Schedule, build_schedule, legacy_index
+from state import StateStore
 from wordguess import WordGuess
 from pubnix import (
+    DRAIN_TIMEOUT,
+    LOGIN_BURST,
+    LOGIN_RATE,
+    MAX_SESSIONS,
+    QUEUE_SIZE,
+    WORKERS,
+    RateLimiter,
+    close_with_error,
+    close_with_error_async,
+    rate_limit_error,
+    run_async_server,
+    run_pool_server,
     run_simple_server,
     receive_message,
-    send_message
+    server_tls,
+    receive_message_async,
+    send_message,
+    send_message_async,
+    start_server
 )
 
+# Clients can send guesses one at a time or several at once
+GUESS_MESSAGES = (WordGuess.GuessMessage, WordGuess.BatchGuessMessage)
+# Per user and second, and in a burst. Invalid guesses
+# don't count against the player, so they are limited
+# separately from the messages they come in.
+MESSAGE_RATE = 10
+MESSAGE_BURST = 60
+INVALID_GUESS_RATE = 1
+INVALID_GUESS_BURST = 30
+# A user's progress is guarded by one of these locks,
+# picked by their name, so that a guess is applied
+# atomically without every player waiting on one lock
+LOCK_STRIPES = 64
+
+GUESSES = Counter("wordguess_guesses_total", "Guesses made, by whether they were valid.", "result")
+GAMES = Counter("wordguess_games_total", "Games finished, by outcome.", "outcome")
+SAVE_STATE = Histogram("wordguess_save_state_seconds", "Time to persist a player's progress.")
+
 class WordGuessServer:
-    def __init__(self, seed, word_length = 5, guesses_allowed = 6):
+    def __init__(
+            self, seed, word_length = 5, guesses_allowed = 6, store = None, results = None,
+            keep_yesterday = True, variant = WordGuess.DEFAULT_VARIANT, hard_mode = False,
+            analytics = None, messages = None, invalid_guesses = None):
         self.seed = seed
         self.word_length = word_length
         self.guesses_allowed = guesses_allowed
-        # date -> user str -> int
-        self.guesses_made = defaultdict(make_default_dict_zero)
-        # date -> user str -> bool
-        self.is_winner = defaultdict(make_default_dict_false)
-        # date -> user str -> set[char]
-        self.letters_guessed = defaultdict(make_default_dict_set)
-
-    def fix_permissions(self):
+        # Name that progress, scores and the
+        # schedule are kept under
+        self.variant = variant
+        self.hard_mode = hard_mode
+        # Where progress is persisted, if anywhere
+        self.store = store
+        # Where scores are recorded, if anywhere
+        self.results = results
+        # Where every guess and game is recorded, if anywhere
+        self.analytics = analytics
+        # RateLimiters of each user's messages and invalid guesses, if any
+        self.messages = messages
+        self.invalid_guesses = invalid_guesses
+        # Whether to hold on to yesterday's players for
+        # games that are still going past midnight
+        self.keep_yesterday = keep_yesterday
+        # date -> user str -> PlayerState
+        # Only the most recent days are kept in memory
+        self.players = dict()
+        self.today = None
+        self.hints = None
+        # Words of the day, without which the
+        # original formula is used
+        self.schedule = None
+        # Cleared while state loads in the background
+        self.ready = Event()
+        self.ready.set()
+        self.locks = [Lock() for _ in range(LOCK_STRIPES)]
+
+    @classmethod
+    def from_variant(cls, seed, variant, **kwargs):
+        rules = WordGuess.VARIANTS[variant]
+        return cls(
+            seed, rules.word_length, rules.guesses_allowed,
+            variant=variant, hard_mode=rules.hard_mode, **kwargs
+        )
+
+    def fix_permissions(self, state_location, results_location, analytics_location):
         """
         Discourage cheating
         by making some files unreadable
@@ -41,14 +115,24 @@ class WordGuessServer:
         """
         # 33152 = '-rw-------.'
         # 33188 = '-rw-r--r--.'
-        SERVER_FOLDER = Path(__file__).parent.absolute()
+        from pathlib import Path
         os.chmod(__file__, 33152)
         os.chmod(f"{SERVER_FOLDER}/pubnix.py", 33188)
         os.chmod(f"{SERVER_FOLDER}/wordguess.py", 33188)
+        os.chmod(f"{SERVER_FOLDER}/dictionary.py", 33188)
+        os.chmod(f"{SERVER_FOLDER}/metrics.py", 33188)
         os.chmod(f"{SERVER_FOLDER}/words.txt", 33188)
+        if os.path.exists(f"{SERVER_FOLDER}/words.dict"):
+            os.chmod(f"{SERVER_FOLDER}/words.dict", 33188)
         os.chmod(f"{SERVER_FOLDER}/client.py", 33188)
-        Path(WordGuess.RESULTS_LOCATION).touch(33188)
-        Path(SAVE_LOCATION).touch(33152)
+        Path(results_location).touch(33188)
+        # The state includes the seed so it
+        # needs to stay private
+        Path(state_location).touch(33152)
+        os.chmod(state_location, 33152)
+        # So do today's guesses
+        Path(analytics_location).touch(33152)
+        os.chmod(analytics_location, 33152)
 
     def game(self, connection, user):
         """
@@ -56,97 +140,423 @@ class WordGuessServer:
         a given user with a specific connection.
         """
 
+        self.ready.wait()
+
         # As long as the connection is alive,
         # treat the time the same
         # NOTE: Timeout specified in pubnix.py
         today = datetime.today().date()
+        self.rollover(today)
+        self.refresh_player(today, user)
         wotd = self.get_wotd(today)
-        
-        # Load from internal state, whether the user
-        # has already won or made guesses
-        gr = self.guesses_allowed - self.guesses_made[today][user]
-        is_winner = self.is_winner[today][user]
-        send_message(connection, WordGuess.GameStartMessage(is_winner, self.word_length, gr, list(self.letters_guessed[today][user])))
+        send_message(connection, self.start_message(today, user))
 
         # No need to play if the user already won today.
-        if self.is_winner[today][user]:
+        if self.player(today, user).is_winner:
             return
 
-        while not self.is_winner[today][user] and self.guesses_made[today][user] < self.guesses_allowed:
-            message = receive_message(connection, WordGuess.GuessMessage)
-            message.word = message.word.lower()
-
-            # If the user made an invalid guess, don't
-            # provide a hint or count it against them.
-            if not self.valid_guess(message.word):
-                send_message(
-                    connection,
-                    WordGuess.GuessResponseMessage(
-                        gr,
-                        False,
-                        False,
-                        "",
-                        list(self.letters_guessed[today][user])
-                    )
-                )
-                continue
+        while not self.game_over(today, user):
+            message = receive_message(connection, GUESS_MESSAGES)
+            error = self.check_message(user)
+            if error is not None:
+                close_with_error(connection, error, "rate_limited")
+            response, error = self.respond(today, user, wotd, message)
+            send_message(connection, response)
+            if error is not None:
+                close_with_error(connection, error, "rate_limited")
+
+    async def game_async(self, connection, user):
+        """
+        Same as game, but for connections
+        handled by pubnix.run_async_server.
+        """
+        if not self.ready.is_set():
+            import asyncio
+            await asyncio.to_thread(self.ready.wait)
+
+        today = datetime.today().date()
+        self.rollover(today)
+        self.refresh_player(today, user)
+        wotd = self.get_wotd(today)
+        await send_message_async(connection, self.start_message(today, user))
+
+        if self.player(today, user).is_winner:
+            return
+
+        while not self.game_over(today, user):
+            message = await receive_message_async(connection, GUESS_MESSAGES)
+            error = self.check_message(user)
+            if error is not None:
+                await close_with_error_async(connection, error, "rate_limited")
+            response, error = self.respond(today, user, wotd, message)
+            await send_message_async(connection, response)
+            if error is not None:
+                await close_with_error_async(connection, error, "rate_limited")
+
+    def check_message(self, user):
+        """
+        Error to close the connection with if the
+        user sends messages too quickly, else None.
+        """
+        if self.messages is None:
+            return None
+        wait = self.messages.take(user)
+        return rate_limit_error("messages", wait) if wait else None
+
+    def check_invalid_guess(self, user, response):
+        """
+        Same as check_message, for the response
+        to a single guess that was invalid.
+        """
+        if self.invalid_guesses is None or response.valid:
+            return None
+        wait = self.invalid_guesses.take(user)
+        return rate_limit_error("invalid guesses", wait) if wait else None
+
+    def finish(self, today, user):
+        """
+        Record the outcome of a game that ran to
+        the end, saving the score of a win. Called
+        once, by the guess that ended the game.
+        """
+        player = self.player(today, user)
+        if player.is_winner:
+            GAMES.inc("win")
+            self.save_record(today, user, self.guesses_remaining(today, user))
+        else:
+            GAMES.inc("loss")
+        if self.analytics is not None:
+            # The winning guess isn't counted against the player
+            guesses = player.guesses_made + player.is_winner
+            self.analytics.game(today, self.variant, user, self.get_wotd(today), player.is_winner, guesses)
+
+    def start_message(self, today, user):
+        """
+        Load from internal state, whether the user
+        has already won or made guesses.
+        """
+        player = self.player(today, user)
+        return WordGuess.GameStartMessage(
+            player.is_winner,
+            self.word_length,
+            self.guesses_remaining(today, user),
+            player.letters_guessed()
+        )
+
+    def player(self, date, user):
+        """
+        Return a user's progress on a date,
+        starting them off if they have none.
+        """
+        day = self.players.get(date)
+        if day is None:
+            day = self.players.setdefault(date, dict())
+        player = day.get(user)
+        if player is None:
+            player = day.setdefault(user, PlayerState())
+        return player
+
+    def guesses_remaining(self, today, user):
+        return self.guesses_allowed - self.player(today, user).guesses_made
+
+    def game_over(self, today, user):
+        player = self.player(today, user)
+        return player.is_winner or player.guesses_made >= self.guesses_allowed
+
+    def lock(self, user):
+        """
+        Lock guarding a user's progress, shared
+        with the other users on its stripe.
+        """
+        return self.locks[hash(user) % LOCK_STRIPES]
 
-            self.is_winner[today][user] = message.word == wotd
-            if not self.is_winner[today][user]:
-                self.guesses_made[today][user] += 1
-            
-            gr = self.guesses_allowed - self.guesses_made[today][user]
-            hint = WordGuessServer.compare(wotd, message.word)
-
-            # Populate letters guessed
-            for c in message.word:
-                self.letters_guessed[today][user].add(c)
-
-            send_message(
-                connection,
-                WordGuess.GuessResponseMessage(
-                    gr,
-                    True,
-                    self.is_winner[today][user],
-                    hint, 
-                    list(self.letters_guessed[today][user])
+    def respond(self, today, user, wotd, message):
+        """
+        Make a single guess or a batch of guesses.
+        Returns the response along with the error to
+        close the connection with after sending it,
+        if the user ran out of invalid guesses. A batch
+        is cut short then or once the game is over.
+        Other sessions of the same user wait until
+        it's done.
+        """
+        with self.lock(user):
+            if isinstance(message, WordGuess.GuessMessage):
+                response = self.make_guess(today, user, wotd, message.word)
+                return response, self.check_invalid_guess(user, response)
+
+            responses = []
+            error = None
+            for word in message.words:
+                if self.game_over(today, user):
+                    break
+                response = self.make_guess(today, user, wotd, word)
+                responses.append(response)
+                error = self.check_invalid_guess(user, response)
+                if error is not None:
+                    break
+            return WordGuess.BatchGuessResponseMessage(responses), error
+
+    def make_guess(self, today, user, wotd, word):
+        """
+        Apply a guess to the user's state and
+        return the response to send back. The
+        caller holds the user's lock.
+        """
+        word = word.lower()
+        player = self.player(today, user)
+
+        # Another session of the user may have
+        # ended the game since this one checked
+        if self.game_over(today, user):
+            GUESSES.inc("game_over")
+            return WordGuess.GuessResponseMessage(
+                self.guesses_remaining(today, user),
+                False,
+                player.is_winner,
+                [],
+                player.letters_guessed()
+            )
+
+        # If the user made an invalid guess, don't
+        # provide a hint or count it against them.
+        if not self.valid_guess(word):
+            GUESSES.inc("invalid")
+            return WordGuess.GuessResponseMessage(
+                self.guesses_remaining(today, user),
+                False,
+                False,
+                [],
+                player.letters_guessed()
+            )
+
+        # Hard mode guesses have to use what the last
+        # guess revealed, otherwise they're invalid too
+        engine = self.hint_engine(wotd)
+        if self.hard_mode and player.last_guess is not None:
+            if not follows_hints(word, player.last_guess, engine.hint(player.last_guess)):
+                GUESSES.inc("invalid")
+                return WordGuess.GuessResponseMessage(
+                    self.guesses_remaining(today, user),
+                    False,
+                    False,
+                    [],
+                    player.letters_guessed()
                 )
+
+        number = player.guesses_made
+        player.is_winner = word == wotd
+        if not player.is_winner:
+            player.guesses_made += 1
+
+        # Populate letters guessed
+        player.add_letters(word)
+        player.last_guess = word
+
+        # While one server hands off to the next, both
+        # can take guesses from the player. Whichever
+        # saves second goes again with the saved progress.
+        if not self.save_state(today, user, number):
+            self.reload_player(today, user)
+            return self.make_guess(today, user, wotd, word)
+
+        GUESSES.inc("valid")
+        hint = engine.hint(word)
+        if self.analytics is not None:
+            self.analytics.guess(today, self.variant, user, number, word, hint)
+
+        if self.game_over(today, user):
+            self.finish(today, user)
+
+        return WordGuess.GuessResponseMessage(
+            self.guesses_remaining(today, user),
+            True,
+            player.is_winner,
+            hint,
+            player.letters_guessed()
+        )
+
+    def load(self, schedule_start, today):
+        """
+        Lay out the schedule and restore
+        the most recent progress.
+        """
+        self.load_schedule(schedule_start)
+        self.load_state(today - timedelta(days=1))
+        self.load_state(today)
+        self.rollover(today)
+
+    def load_in_background(self, schedule_start):
+        """
+        Load on another thread so the server can start
+        accepting connections. Games wait until it's done.
+        """
+        self.ready.clear()
+        def run():
+            start = perf_counter()
+            try:
+                self.load(schedule_start, datetime.today().date())
+            except Exception as e:
+                # Without the state players could replay the day
+                print(f"Cannot load {self.variant} game state:", repr(e))
+                os._exit(1)
+            print(f"Loaded {self.variant} game state in {perf_counter() - start:.2f} s")
+            self.ready.set()
+        Thread(target=run, name=f"load-{self.variant}", daemon=True).start()
+
+    def load_state(self, date):
+        """
+        Restore every player's progress
+        for a day from the state store.
+        """
+        day = self.players.setdefault(date, dict())
+        for row in self.store.load_day(date, self.variant):
+            day[row[2]] = player_from_row(row)
+
+    def refresh_player(self, date, user):
+        """
+        Reload a player's progress at the start of
+        a game. While one server hands off to the
+        next, both save the progress of the
+        players they serve.
+        """
+        if self.store is None:
+            return
+        with self.lock(user):
+            self.reload_player(date, user)
+
+    def reload_player(self, date, user):
+        """
+        Same as refresh_player, for a caller
+        already holding the user's lock.
+        """
+        row = self.store.load_player(date, self.variant, user)
+        if row is not None:
+            self.players.setdefault(date, dict())[user] = player_from_row(row)
+
+    def save_state(self, date, user, previous):
+        """
+        Persist a player's progress right away
+        so that it survives a crash. Returns False
+        if the server we're handing off with saved
+        a guess after previous guesses first.
+        """
+        if self.store is None:
+            return True
+        with SAVE_STATE.time():
+            player = self.player(date, user)
+            return self.store.save_player(
+                date,
+                self.variant,
+                user,
+                previous,
+                player.guesses_made,
+                player.is_winner,
+                player.letters_guessed(),
+                player.last_guess
             )
-        
-        if self.is_winner[today][user]:
-            WordGuessServer.save_record(today, user, gr)
 
-    @staticmethod
-    def save_record(date, username, score):
+    def stop_guesses(self):
+        """
+        Wait for the guesses being made and hold
+        off any more, so that the stores can be
+        closed with nothing left to write.
+        """
+        for lock in self.locks:
+            lock.acquire()
+
+    def rollover(self, today):
+        """
+        Drop finished days from memory once the
+        date changes. Their progress is already
+        in the state store.
+        """
+        if today == self.today:
+            return
+        self.today = today
+
+        oldest = today - timedelta(days=1) if self.keep_yesterday else today
+        for date in list(self.players):
+            if date < oldest:
+                self.players.pop(date, None)
+
+        players, size = self.memory_footprint()
+        print(f"Rolled over {self.variant} to {today}: {players} players in memory (~{size} bytes)")
+
+    def memory_footprint(self):
+        """
+        Number of players held in memory
+        and roughly how many bytes they take.
+        """
+        players = 0
+        size = sys.getsizeof(self.players)
+        for day in list(self.players.values()):
+            players += len(day)
+            size += sys.getsizeof(day)
+            for user, player in list(day.items()):
+                size += sys.getsizeof(user) + player.sizeof()
+        return players, size
+
+    def save_record(self, date, username, score):
         """
         Save score that user acheived into
         results database for leaderboard viewing.
+        The write happens on the results writer's
+        thread so this never waits on the disk.
         """
-        con = sqlite3.connect(WordGuess.RESULTS_LOCATION)
-        try:
-            cur = con.cursor()
-            cur.execute(
-                "CREATE TABLE IF NOT EXISTS scores(user TEXT NOT NULL, score INT NOT NULL, date TIMESTAMP NOT NULL, PRIMARY KEY (user, date))"
-            )
-            cur.execute("INSERT INTO scores VALUES (?, ?, ?)", (username, score, date))
-            con.commit()
-        except sqlite3.IntegrityError:
-            print("Cannot write record:", (date, username, score))
-        finally:
-            con.close()
-
-    @lru_cache
+        if self.results is not None:
+            self.results.submit(date, username, score, self.variant)
+
     def get_words(self):
-        words = []
-        with open("words.txt", "r") as file:
-            lines = file.read().splitlines()
-            words.extend([l for l in lines if len(l) == self.word_length])
-        return words
+        return load_index().words_of_length(self.word_length)
 
     def get_wotd(self, day):
-        words = self.get_words()
-        index = (day.year * day.month * day.day * self.seed) % len(words)
-        return words[index]
+        schedule = self.schedule
+        if schedule is None or day < schedule.start:
+            words = self.get_words()
+            return words[legacy_index(self.seed, day, len(words))]
+        if day >= schedule.end:
+            schedule = self.extend_schedule(day)
+        return schedule.get(day)
+
+    def load_schedule(self, start):
+        """
+        Use the schedule kept in the store, or lay one
+        out from start if there isn't one yet. Days
+        before start keep their original words.
+        """
+        stored = None
+        if self.store is not None:
+            stored = self.store.load_schedule(self.variant)
+        if stored is not None:
+            self.schedule = Schedule(*stored)
+            return
+        self.schedule = build_schedule(self.schedule_seed(), self.get_words(), start)
+        self.save_schedule()
+
+    def extend_schedule(self, day):
+        """
+        Lay out another horizon's worth of days
+        past day. Earlier days don't change.
+        """
+        start = self.schedule.start
+        days = (day - start).days + HORIZON
+        self.schedule = build_schedule(self.schedule_seed(), self.get_words(), start, days)
+        self.save_schedule()
+        return self.schedule
+
+    def save_schedule(self):
+        if self.store is not None:
+            self.store.save_schedule(self.variant, self.schedule.start, self.schedule.words)
+
+    def schedule_seed(self):
+        """
+        Variants with the same word length
+        still get different words.
+        """
+        if self.variant == WordGuess.DEFAULT_VARIANT:
+            return self.seed
+        return f"{self.seed}:{self.variant}"
 
     def valid_guess(self, guess: str):
         """
@@ -159,11 +569,22 @@ class WordGuessServer:
 
         # Guess needs to be part of our
         # dictionary
-        if guess not in self.get_words():
+        if guess not in load_index():
             return False
 
         return True
 
+    def hint_engine(self, wotd):
+        """
+        Return the hint engine for the word of the day,
+        only building a new one when the word changes.
+        """
+        engine = self.hints
+        if engine is None or engine.word != wotd:
+            engine = HintEngine(wotd)
+            self.hints = engine
+        return engine
+
     @staticmethod
     def compare(expected: str, guess: str) -> List[str]:
         """
@@ -205,6 +626,121 @@ def char_positions(word: str):
         result[char].append(i)
     return result
 
+def player_from_row(row):
+    _, _, _, guesses_made, is_winner, letters, last_guess = row
+    player = PlayerState(guesses_made, bool(is_winner), last_guess=last_guess)
+    player.add_letters(letters)
+    return player
+
+def import_pickle(store, location):
+    """
+    Move the state saved by older versions
+    of the server into the state store.
+    Returns the seed that was in use.
+    """
+    import pickle
+    with open(location, "rb") as file:
+        old = pickle.load(file)
+
+    rows = []
+    dates = set(old.guesses_made) | set(old.is_winner) | set(old.letters_guessed)
+    for date in dates:
+        users = set(old.guesses_made[date]) | set(old.is_winner[date]) | set(old.letters_guessed[date])
+        for user in users:
+            rows.append((
+                str(date),
+                WordGuess.DEFAULT_VARIANT,
+                user,
+                old.guesses_made[date][user],
+                old.is_winner[date][user],
+                "".join(sorted(old.letters_guessed[date][user])),
+                None
+            ))
+    store.save_players(rows)
+    store.set_setting("seed", old.seed)
+    return old.seed
+
+def follows_hints(guess: str, previous: str, hint: List[str]) -> bool:
+    """
+    Whether a guess keeps every letter found in the
+    right position by the previous guess, and uses
+    every letter that was marked with a *.
+    """
+    needed = set()
+    for g_char, p_char, h in zip(guess, previous, hint):
+        if h == p_char and g_char != p_char:
+            return False
+        if h == "*":
+            needed.add(p_char)
+    return all(c in guess for c in needed)
+
+class HintEngine:
+    """
+    Gives the same hints as WordGuessServer.compare
+    for a single word of the day. How often each
+    letter appears in the word is counted once, so
+    each guess is scored in one pass.
+
+    As in compare, a letter in the wrong position
+    gets a * as long as the word has more of that
+    letter than were already marked with a * to its
+    left. Letters in the right position don't count
+    against this.
+    """
+    __slots__ = ("word", "counts")
+
+    def __init__(self, word: str):
+        self.word = word
+        self.counts = dict()
+        for c in word:
+            self.counts[c] = self.counts.get(c, 0) + 1
+
+    def hint(self, guess: str) -> List[str]:
+        remaining = self.counts.copy()
+        output = []
+        for e_char, g_char in zip(self.word, guess):
+            if e_char == g_char:
+                output.append(g_char)
+            elif remaining.get(g_char, 0) > 0:
+                output.append("*")
+                remaining[g_char] -= 1
+            else:
+                output.append("_")
+        return output
+
+class PlayerState:
+    """
+    A user's progress for a single day.
+    Letters guessed are kept as a bitmask
+    indexed by character code.
+    """
+    __slots__ = ("guesses_made", "is_winner", "letters", "last_guess")
+
+    def __init__(self, guesses_made = 0, is_winner = False, letters = 0, last_guess = None):
+        self.guesses_made = guesses_made
+        self.is_winner = is_winner
+        self.letters = letters
+        # Only needed to enforce hard mode
+        self.last_guess = last_guess
+
+    def add_letters(self, word: str):
+        for c in word:
+            self.letters |= 1 << ord(c)
+
+    def letters_guessed(self) -> List[str]:
+        letters = []
+        mask = self.letters
+        while mask:
+            lowest = mask & -mask
+            letters.append(chr(lowest.bit_length() - 1))
+            mask ^= lowest
+        return letters
+
+    def sizeof(self):
+        return sys.getsizeof(self) + sys.getsizeof(self.letters)
+
+# The factories below are referenced by
+# state.pickle files from older versions
 def make_zero():
     return 0
 
@@ -220,34 +756,167 @@ def make_default_dict_false():
 def make_default_dict_set():
     return defaultdict(set)
 
-SERVER_FOLDER = Path(__file__).parent.absolute()
+SERVER_FOLDER = os.path.dirname(os.path.abspath(__file__))
 SAVE_LOCATION = f"{SERVER_FOLDER}/state.pickle"
+STATE_LOCATION = f"{SERVER_FOLDER}/state.db"
+ADMIN_ADDRESS = f"{SERVER_FOLDER}/admin.sock"
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="WordGuess Game Server")
+    parser.add_argument(
+        "--mode", choices=["thread", "async", "pool"], default="thread",
+        help="Serve each connection on its own thread, as an asyncio task, or from a fixed pool of threads."
+    )
+    parser.add_argument(
+        "--max-sessions", type=int, default=MAX_SESSIONS,
+        help="Maximum number of concurrent sessions in async mode."
+    )
+    parser.add_argument("--workers", type=int, default=WORKERS, help="Worker threads in pool mode.")
+    parser.add_argument(
+        "--queue-size", type=int, default=QUEUE_SIZE,
+        help="Connections waiting for a worker before new ones are turned away in pool mode."
+    )
+    parser.add_argument("--backlog", type=int, help="Length of the socket's listen queue in pool mode.")
+    parser.add_argument(
+        "--address", type=str, default=WordGuess.ADDRESS,
+        help="Path of the game socket, or tcp://host:port to serve a router (see router.py)."
+    )
+    parser.add_argument("--tls-cert", type=str, help="Serve TCP over TLS with this certificate chain.")
+    parser.add_argument("--tls-key", type=str, help="Private key of the TLS certificate, if not in --tls-cert.")
+    parser.add_argument(
+        "--cluster", type=str,
+        help="Run as a shard, taking the seed and shard key from this cluster file (see router.py)."
+    )
+    parser.add_argument("--state", type=str, default=STATE_LOCATION, help="Location of the private game state.")
+    parser.add_argument("--results", type=str, default=WordGuess.RESULTS_LOCATION, help="Location of the results.")
+    parser.add_argument(
+        "--analytics", type=str, default=ANALYTICS_LOCATION,
+        help="Location of the private record of every game, archived next to it (see analytics.py)."
+    )
+    parser.add_argument(
+        "--admin", type=str, nargs="?", const=ADMIN_ADDRESS,
+        help="Serve metrics and the profiler on a private socket, by default admin.sock."
+    )
+    parser.add_argument(
+        "--drain-timeout", type=float, default=DRAIN_TIMEOUT,
+        help="Seconds that active games get to finish on SIGTERM, or on SIGHUP once a new server has taken over."
+    )
+    parser.add_argument(
+        "--variants", nargs="+", choices=WordGuess.VARIANTS, default=list(WordGuess.VARIANTS),
+        help="Games to host. Those without words of the right length in the dictionary are skipped."
+    )
+    parser.add_argument(
+        "--no-rate-limits", action="store_true",
+        help="Let users log in, send messages and make invalid guesses as fast as they like, such as for load tests."
+    )
+    args = parser.parse_args()
+
+    store = StateStore(args.state)
+
     # NOTE: The seed must be kept secret otherwise
     # players can cheat!
-    SEED = random.randint(3, 1000000)
-
-    w = WordGuessServer(SEED)
-
-    # Load game state if existent
-    if os.path.exists(SAVE_LOCATION):
-        with open(SAVE_LOCATION, "rb") as file:
-            w = pickle.load(file)
-            print("Successfully loaded game state")
-
-    print("Seed: ", w.seed)
-    
-    # Make sure permissions are correct
-    # to prevent cheating...
-    w.fix_permissions()
-    
-    # Start game server
+    SEED = store.get_setting("seed")
+    # Servers that were already running keep their
+    # words until tomorrow, new ones use the schedule
+    # from the start
+    SCHEDULE_START = datetime.today().date() + timedelta(days=1)
+    if args.cluster is not None:
+        # Every shard has the same words
+        from router import join_cluster
+        SEED, SCHEDULE_START = join_cluster(store, args.cluster)
+    elif SEED is None and os.path.exists(SAVE_LOCATION):
+        SEED = import_pickle(store, SAVE_LOCATION)
+        print("Imported game state from", SAVE_LOCATION)
+    elif SEED is None:
+        SEED = random.randint(3, 1000000)
+        store.set_setting("seed", SEED)
+        SCHEDULE_START = SCHEDULE_EPOCH
+
+    # Signs the session tokens that let
+    # players reconnect without a challenge
+    SESSION_KEY = store.get_setting("session_key")
+    if SESSION_KEY is None:
+        SESSION_KEY = os.urandom(32).hex()
+        store.set_setting("session_key", SESSION_KEY)
+    SESSION_KEY = bytes.fromhex(SESSION_KEY)
+
+    # A user's limits hold across every game
+    logins = messages = invalid_guesses = None
+    if not args.no_rate_limits:
+        logins = RateLimiter("logins", LOGIN_RATE, LOGIN_BURST)
+        messages = RateLimiter("messages", MESSAGE_RATE, MESSAGE_BURST)
+        invalid_guesses = RateLimiter("invalid_guesses", INVALID_GUESS_RATE, INVALID_GUESS_BURST)
+
+    # Every variant shares the dictionary, the state
+    # store, the results writer and the analytics writer
+    results = ResultsWriter(args.results)
+    analytics = AnalyticsWriter(args.analytics)
+    games = dict()
+    admin = ExitStack()
     try:
-        run_simple_server(WordGuess.ADDRESS, w.game)
+        for variant in args.variants:
+            w = WordGuessServer.from_variant(
+                SEED, variant, store=store, results=results, analytics=analytics,
+                messages=messages, invalid_guesses=invalid_guesses
+            )
+            if len(w.get_words()) == 0:
+                print(f"Skipping {variant}: no words of length {w.word_length} in the dictionary")
+                continue
+            games[variant] = w
+        if WordGuess.DEFAULT_VARIANT not in games:
+            print(f"The {WordGuess.DEFAULT_VARIANT} game has to be hosted")
+            sys.exit(1)
+
+        # Only the most recent progress is needed in memory, and
+        # it's loaded while the server already takes connections
+        for variant, w in games.items():
+            # Only the classic game existed before schedules
+            w.load_in_background(SCHEDULE_START if variant == WordGuess.DEFAULT_VARIANT else SCHEDULE_EPOCH)
+        print("Loading game state for", ", ".join(games))
+
+        print("Seed: ", SEED)
+
+        # Make sure permissions are correct
+        # to prevent cheating...
+        games[WordGuess.DEFAULT_VARIANT].fix_permissions(args.state, args.results, args.analytics)
+
+        tls = None
+        if args.tls_cert is not None:
+            tls = server_tls(args.tls_cert, args.tls_key)
+
+        # Clients that don't ask for a game get the classic one
+        handlers = {name: w.game_async if args.mode == "async" else w.game for name, w in games.items()}
+        handlers[None] = handlers[WordGuess.DEFAULT_VARIANT]
+
+        # Start game server
+        if args.admin is not None:
+            start_admin_server(admin.enter_context(start_server(args.admin, allow_other=False)))
+            print("Admin socket at", args.admin)
+        if args.mode == "async":
+            run_async_server(
+                args.address, handlers, max_sessions=args.max_sessions,
+                session_key=SESSION_KEY, drain_timeout=args.drain_timeout, tls=tls, logins=logins
+            )
+        elif args.mode == "pool":
+            run_pool_server(
+                args.address, handlers, workers=args.workers,
+                queue_size=args.queue_size, backlog=args.backlog,
+                session_key=SESSION_KEY, drain_timeout=args.drain_timeout, tls=tls, logins=logins
+            )
+        else:
+            run_simple_server(
+                args.address, handlers, session_key=SESSION_KEY,
+                drain_timeout=args.drain_timeout, tls=tls, logins=logins
+            )
     finally:
-        # After finishing, save game state
+        # Progress is saved as it's made, only
+        # the write-ahead log is left to fold in
         print("Saving game state... ", end="")
-        with open(SAVE_LOCATION, "wb") as file:
-            pickle.dump(w, file)
+        # Sessions cut off by the drain can still be mid guess
+        for w in games.values():
+            w.stop_guesses()
+        results.close()
+        analytics.close()
+        store.close()
+        admin.close()
         print("Done.")
@@ -0,0 +1,198 @@
+"""
+WordGuess Game State Store
+Author: Brandon Rozek
+
+Keeps the server's private state in a SQLite
+database in WAL mode. Every guess updates the
+player's row for the day as soon as it is made,
+so a crash or kill loses nothing, and a restart
+only reads back the current day.
+"""
+from datetime import date
+from threading import Lock
+from typing import Iterable, List, Optional, Tuple
+import os
+import sqlite3
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS settings(
+    key TEXT PRIMARY KEY,
+    value NOT NULL
+);
+CREATE TABLE IF NOT EXISTS players(
+    date TEXT NOT NULL,
+    variant TEXT NOT NULL DEFAULT 'classic',
+    user TEXT NOT NULL,
+    guesses_made INT NOT NULL,
+    is_winner INT NOT NULL,
+    letters TEXT NOT NULL,
+    last_guess TEXT,
+    PRIMARY KEY (date, variant, user)
+);
+-- Words of the day, one per line,
+-- for each game variant
+CREATE TABLE IF NOT EXISTS schedule(
+    variant TEXT PRIMARY KEY,
+    start TEXT NOT NULL,
+    words TEXT NOT NULL
+);
+"""
+
+# Before there were variants, players were kept by date and
+# user, and the only schedule was for 5 letter words
+MIGRATIONS = {
+    "players": """
+ALTER TABLE players RENAME TO players_old;
+CREATE TABLE players(
+    date TEXT NOT NULL,
+    variant TEXT NOT NULL DEFAULT 'classic',
+    user TEXT NOT NULL,
+    guesses_made INT NOT NULL,
+    is_winner INT NOT NULL,
+    letters TEXT NOT NULL,
+    last_guess TEXT,
+    PRIMARY KEY (date, variant, user)
+);
+INSERT INTO players(date, user, guesses_made, is_winner, letters)
+    SELECT date, user, guesses_made, is_winner, letters FROM players_old;
+DROP TABLE players_old;
+""",
+    "schedule": """
+DELETE FROM schedule WHERE length != 5;
+UPDATE schedule SET length = 'classic';
+ALTER TABLE schedule RENAME COLUMN length TO variant;
+""",
+}
+
+# date, variant, user, guesses made, is winner, letters guessed, last guess
+PlayerRow = Tuple[str, str, str, int, bool, str, Optional[str]]
+
+def make_private(location: str):
+    """
+    Create a database that only we can read before
+    SQLite opens it, since its write-ahead log and
+    shared memory files take on its permissions.
+    Ones left readable by an older run are fixed too.
+    """
+    os.close(os.open(location, os.O_WRONLY | os.O_CREAT, 0o600))
+    for path in (location, f"{location}-wal", f"{location}-shm", f"{location}-journal"):
+        if os.path.exists(path):
+            os.chmod(path, 0o600)
+
+class StateStore:
+    def __init__(self, location: str):
+        # Holds the seed and the session key
+        make_private(location)
+        # The connection is shared by all game
+        # threads and guarded by our own lock
+        self.con = sqlite3.connect(location, check_same_thread=False)
+        self.lock = Lock()
+        self.con.execute("PRAGMA journal_mode=WAL")
+        # Commits survive the process dying without
+        # waiting on an fsync for every guess
+        self.con.execute("PRAGMA synchronous=NORMAL")
+        self.migrate()
+        self.con.executescript(SCHEMA)
+        self.compact()
+
+    def migrate(self):
+        """
+        Bring tables made by older versions up to date.
+        """
+        for table, script in MIGRATIONS.items():
+            columns = [row[1] for row in self.con.execute(f"PRAGMA table_info({table})")]
+            if columns and "variant" not in columns:
+                self.con.executescript(f"BEGIN; {script} COMMIT;")
+
+    def get_setting(self, key: str, default=None):
+        with self.lock:
+            row = self.con.execute("SELECT value FROM settings WHERE key = ?", (key,)).fetchone()
+        return default if row is None else row[0]
+
+    def set_setting(self, key: str, value):
+        with self.lock, self.con:
+            self.con.execute(
+                "INSERT INTO settings VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+                (key, value)
+            )
+
+    def save_player(
+            self, date, variant: str, user: str, previous: int, guesses_made: int,
+            is_winner: bool, letters: Iterable[str], last_guess: Optional[str] = None) -> bool:
+        """
+        Record a player's progress for the day after a guess
+        made with previous guesses behind it. Returns False,
+        saving nothing, if another server sharing the store
+        has saved a guess of theirs in the meantime.
+        """
+        with self.lock, self.con:
+            cursor = self.con.execute(
+                "INSERT INTO players VALUES (?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT(date, variant, user) DO UPDATE SET "
+                "guesses_made = excluded.guesses_made, "
+                "is_winner = excluded.is_winner, "
+                "letters = excluded.letters, "
+                "last_guess = excluded.last_guess "
+                "WHERE players.guesses_made = ? AND NOT players.is_winner",
+                (str(date), variant, user, guesses_made, is_winner, "".join(sorted(letters)), last_guess, previous)
+            )
+            return cursor.rowcount > 0
+
+    def save_players(self, rows: Iterable[PlayerRow]):
+        with self.lock, self.con:
+            self.con.executemany(
+                "INSERT INTO players VALUES (?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT(date, variant, user) DO UPDATE SET "
+                "guesses_made = excluded.guesses_made, "
+                "is_winner = excluded.is_winner, "
+                "letters = excluded.letters, "
+                "last_guess = excluded.last_guess",
+                rows
+            )
+
+    def load_day(self, date, variant: str) -> Iterable[PlayerRow]:
+        with self.lock:
+            return self.con.execute(
+                "SELECT date, variant, user, guesses_made, is_winner, letters, last_guess "
+                "FROM players WHERE date = ? AND variant = ?",
+                (str(date), variant)
+            ).fetchall()
+
+    def load_player(self, date, variant: str, user: str) -> Optional[PlayerRow]:
+        with self.lock:
+            return self.con.execute(
+                "SELECT date, variant, user, guesses_made, is_winner, letters, last_guess "
+                "FROM players WHERE date = ? AND variant = ? AND user = ?",
+                (str(date), variant, user)
+            ).fetchone()
+
+    def load_schedule(self, variant: str) -> Optional[Tuple[date, List[str]]]:
+        with self.lock:
+            row = self.con.execute(
+                "SELECT start, words FROM schedule WHERE variant = ?", (variant,)
+            ).fetchone()
+        if row is None:
+            return None
+        return date.fromisoformat(row[0]), row[1].split("\n")
+
+    def save_schedule(self, variant: str, start: date, words: List[str]):
+        with self.lock, self.con:
+            self.con.execute(
+                "INSERT INTO schedule VALUES (?, ?, ?) "
+                "ON CONFLICT(variant) DO UPDATE SET start = excluded.start, words = excluded.words",
+                (variant, str(start), "\n".join(words))
+            )
+
+    def compact(self):
+        """
+        Fold the write-ahead log back into the
+        database and truncate it. SQLite also does
+        this on its own every 1000 pages.
+        """
+        with self.lock:
+            self.con.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+    def close(self):
+        self.compact()
+        with self.lock:
+            self.con.close()
@@ -5,33 +5,90 @@ Author: Brandon Rozek
 Contains common data structures
 between WordGuess client and server
 """
-from dataclasses import dataclass
-from pathlib import Path
+from dataclasses import dataclass, field
+from typing import List
+import os
 
-SERVER_FOLDER = Path(__file__).parent.absolute()
+from pubnix import register_message
+
+SERVER_FOLDER = os.path.dirname(os.path.abspath(__file__))
 
 class WordGuess:
     RESULTS_LOCATION = f"{SERVER_FOLDER}/results.db"
     ADDRESS = f"{SERVER_FOLDER}/game.sock"
+    MAX_BATCH_GUESSES = 64
+
+    @dataclass(frozen=True, slots=True)
+    class Variant:
+        """
+        Rules of a game served alongside the others.
+        In hard mode, letters revealed by the last
+        guess have to be used in the next one.
+        """
+        word_length: int
+        guesses_allowed: int
+        hard_mode: bool = False
 
-    @dataclass
+    VARIANTS = {
+        "classic": Variant(5, 6),
+        "hard": Variant(5, 6, hard_mode=True),
+        "four": Variant(4, 6),
+        "six": Variant(6, 6),
+        "seven": Variant(7, 7),
+    }
+    DEFAULT_VARIANT = "classic"
+
+    @register_message(16)
+    @dataclass(slots=True)
     class GuessMessage:
         word: str
         action: str = "guess"
         def __post_init__(self):
             assert self.action == "guess"
 
-    @dataclass
+    @register_message(17)
+    @dataclass(slots=True)
     class GuessResponseMessage:
         guesses_remaining: int
         valid: bool = False
         winner: bool = False
-        hint: str = ""
-        letters_guessed: str = ""
+        hint: List[str] = field(default_factory=list)
+        letters_guessed: List[str] = field(default_factory=list)
 
-    @dataclass
+    @register_message(18)
+    @dataclass(slots=True)
     class GameStartMessage:
         is_winner: bool
         num_characters: int
         guesses_remaining: int
-        letters_guessed: str
+        letters_guessed: List[str]
+
+    @register_message(19)
+    @dataclass(slots=True)
+    class BatchGuessMessage:
+        """
+        Several guesses to be made in order. The server
+        stops at a win or when guesses run out.
+        """
+        words: List[str]
+        action: str = "batch_guess"
+        def __post_init__(self):
+            assert self.action == "batch_guess"
+            assert len(self.words) <= WordGuess.MAX_BATCH_GUESSES
+
+    @register_message(20)
+    @dataclass(slots=True)
+    class BatchGuessResponseMessage:
+        """
+        One response per guess that was made,
+        which may be fewer than were sent.
+        """
+        responses: List["WordGuess.GuessResponseMessage"]
+        type: str = "batch_guess_response"
+        def __post_init__(self):
+            assert self.type == "batch_guess_response"
+            # JSON gives us dictionaries
+            self.responses = [
+                r if isinstance(r, WordGuess.GuessResponseMessage) else WordGuess.GuessResponseMessage(**r)
+                for r in self.responses
+            ]